@@ -0,0 +1,78 @@
+'''
+Benchmark of the clustering backends of the cluster model. For every input size it builds synthetic weekly humidity
+records, fits every backend on them and on a second, slightly changed version of them (a fraction of the records
+re-measured, as between two scheduled runs), and reports:
+
+- the runtime of each fit,
+- the stability of the Good/Moderate/Bad assignment between the two runs,
+- the agreement of the assignment with the original KMeans path,
+- the runtime of the fit partitioned by origin airport: optimal1d solving all the partitions at once, kmeans with every
+  number of worker processes given.
+
+Usage: python benchmarks/clustering_benchmark.py [--sizes 10000 100000 1000000] [--changed 0.01] [--workers 1 2 4]
+
+'''
+# Importation of libraries
+import os, sys, time, argparse, numpy, pandas
+
+# Make the cluster model modules and the shared modules importable
+for directory in ["deps", "cluster-model"]:
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src", directory))
+import workerPool, clustering_engine
+
+# Function to build synthetic weekly humidity records, a mix of dry, temperate and humid airports
+def synthetic_records(size, rng):
+    centers = rng.choice([30.0, 55.0, 80.0], size=size, p=[0.3, 0.45, 0.25])
+    humidity = numpy.clip(rng.normal(centers, 9.0), 0, 100).round(2)
+    return pandas.DataFrame({"week": rng.integers(1, 5, size), "origin": rng.integers(0, 300, size).astype(str), "humidity": humidity})
+
+# Function to re-measure a fraction of the records
+def perturb(record, fraction, rng):
+    record = record.copy()
+    changed = rng.random(len(record)) < fraction
+    record.loc[changed, "humidity"] = numpy.clip(record.loc[changed, "humidity"] + rng.normal(0, 5.0, changed.sum()), 0, 100).round(2)
+    return record
+
+# Function to rank the clusters of a fit by ascending mean humidity, as the cluster model does
+def ranks(record, labels):
+    means = pandas.Series(record["humidity"].to_numpy()).groupby(labels).mean().sort_values()
+    order = {cluster: rank for rank, cluster in enumerate(means.index)}
+    return numpy.vectorize(order.get)(labels)
+
+# Function to time a fit and return the ranks it assigns
+def timed_ranks(record, backend):
+    start = time.perf_counter()
+    result = clustering_engine.fit(record, backend)
+    return ranks(record, result.labels), time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 1000000], help="Numbers of weekly records")
+    parser.add_argument("--changed", type=float, default=0.01, help="Fraction of records re-measured between the two runs")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, workerPool.available_cpus()], help="Numbers of worker processes of the partitioned fit")
+    arguments = parser.parse_args()
+
+    print(f"{'rows':>9} {'backend':>10} {'run 1 (s)':>10} {'run 2 (s)':>10} {'stability':>10} {'vs kmeans':>10}")
+    for size in arguments.sizes:
+        rng = numpy.random.default_rng(42)
+        first = synthetic_records(size, rng)
+        second = perturb(first, arguments.changed, rng)
+        clustering_engine.previous_centroids.clear()
+        reference, _ = timed_ranks(first, "kmeans")
+        for backend in clustering_engine.backends:
+            first_ranks, first_seconds = timed_ranks(first, backend)
+            second_ranks, second_seconds = timed_ranks(second, backend)
+            stability = (first_ranks == second_ranks).mean()
+            agreement = (first_ranks == reference).mean()
+            print(f"{size:>9} {backend:>10} {first_seconds:>10.3f} {second_seconds:>10.3f} {stability:>10.4f} {agreement:>10.4f}")
+
+    print(f"\n{'rows':>9} {'backend':>10} {'workers':>10} {'partitioned by origin (s)':>26}")
+    for size in arguments.sizes:
+        record = synthetic_records(size, numpy.random.default_rng(42))
+        for backend, workers in [("optimal1d", 1)] + [("kmeans", workers) for workers in sorted(set(arguments.workers))]:
+            start = time.perf_counter()
+            clustering_engine.fit_partitions(record, "origin", backend, min_rows=50, workers=workers)
+            print(f"{size:>9} {backend:>10} {workers:>10} {time.perf_counter() - start:>26.3f}")
+
+if __name__ == "__main__":
+    main()
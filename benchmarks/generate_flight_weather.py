@@ -0,0 +1,96 @@
+'''
+Synthetic generator of the flight weather CSV read by the data pipeline, so benchmarks run without the Kaggle download
+and at any size. It writes the columns read by the pipeline (TAIL_NUM, ORIGIN, DEST, MONTH, DAY_OF_MONTH, YEAR and
+RelativeHumidityOrigin) next to a few unread weather columns, so the parser skips fields as it does on the real file.
+
+The data follows the shape of the real dataset: a few thousand aircraft flying between a few hundred airports whose
+traffic follows a power law (hubs dominate), rows in date order over two years, a humidity per origin airport made of its
+climate, a seasonal swing and noise, with a small share of missing readings. Every chunk is drawn from its own seeded
+generator, so a given seed and size always produce the same file.
+
+Usage: python benchmarks/generate_flight_weather.py [--scale 1.7M|17M|170M | --rows N] [--output data/synthetic.csv]
+
+'''
+# Importation of libraries
+import os, string, argparse, datetime, numpy, pandas
+
+# Preset sizes, the real dataset holds about 1.7 million rows
+scales = {"1.7M": 1700000, "17M": 17000000, "170M": 170000000}
+
+# Number of rows generated and written at a time
+chunk_rows = 1000000
+
+# Cardinalities and missing value rate of the generated data
+aircraft = 6000
+airports = 350
+missing_humidity_rate = 0.015
+first_day = datetime.date(2018, 1, 1)
+days = 730
+
+# Function to build the fixed dimensions of the data: tail numbers, airport codes, airport traffic and climates
+def dimensions(seed):
+    rng = numpy.random.default_rng([seed, 0])
+    letters = numpy.array(list(string.ascii_uppercase))
+    tails = numpy.array([f"N{number}{''.join(rng.choice(letters, 2))}" for number in rng.choice(numpy.arange(100, 9999), aircraft, replace=False)])
+    codes = set()
+    while len(codes) < airports:
+        codes.add("".join(rng.choice(letters, 3)))
+    codes = numpy.array(sorted(codes))
+    # Airport traffic follows a power law, so hubs see most departures
+    traffic = 1.0 / numpy.arange(1, airports + 1) ** 0.9
+    traffic = rng.permutation(traffic / traffic.sum())
+    # Every airport has its own mean humidity and seasonal swing
+    climate = rng.uniform(35, 85, airports)
+    swing = rng.uniform(3, 15, airports)
+    return tails, codes, traffic, climate, swing
+
+# Function to generate a chunk of rows starting at a given row of the file
+def generate_chunk(seed, start, rows, total, tails, codes, traffic, climate, swing):
+    # Seed the chunk by its first row, so every chunk, appended ones included, draws its own values
+    rng = numpy.random.default_rng([seed, start + 1])
+    # Spread the rows over the date range in order, as in the real file
+    day_offsets = (numpy.arange(start, start + rows, dtype=numpy.int64) * days) // max(total, 1)
+    dates = pandas.to_datetime(first_day) + pandas.to_timedelta(day_offsets, unit="D")
+    origin = rng.choice(airports, rows, p=traffic)
+    dest = rng.choice(airports, rows, p=traffic)
+    dest = numpy.where(dest == origin, (dest + 1) % airports, dest)
+    # Humidity of the origin: climate, seasonal swing peaking mid-year and noise, clipped to a percentage
+    season = numpy.sin(2 * numpy.pi * (dates.dayofyear.to_numpy() - 80) / 365.0)
+    humidity = numpy.clip(climate[origin] + swing[origin] * season + rng.normal(0, 10, rows), 0, 100).round(1)
+    humidity[rng.random(rows) < missing_humidity_rate] = numpy.nan
+    return pandas.DataFrame({
+        "YEAR": dates.year,
+        "MONTH": dates.month,
+        "DAY_OF_MONTH": dates.day,
+        "TAIL_NUM": tails[rng.integers(0, aircraft, rows)],
+        "ORIGIN": codes[origin],
+        "DEST": codes[dest],
+        "DEP_DELAY": rng.exponential(12, rows).round(0),
+        "TemperatureOrigin": rng.normal(18, 9, rows).round(1),
+        "WindSpeedOrigin": rng.gamma(2, 4, rows).round(1),
+        "RelativeHumidityOrigin": humidity,
+    })
+
+# Function to write a synthetic CSV file of the given size, or to append rows following an existing one
+def generate(path, rows, seed=42, append_to=0):
+    tails, codes, traffic, climate, swing = dimensions(seed)
+    total = append_to + rows
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "a" if append_to else "w", newline="") as handle:
+        for start in range(append_to, total, chunk_rows):
+            chunk = generate_chunk(seed, start, min(chunk_rows, total - start), total, tails, codes, traffic, climate, swing)
+            chunk.to_csv(handle, header=(start == 0), index=False)
+    return path
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scale", choices=list(scales), default="1.7M", help="Preset number of rows")
+    parser.add_argument("--rows", type=int, help="Number of rows, overriding the preset")
+    parser.add_argument("--seed", type=int, default=42, help="Seed of the generator")
+    parser.add_argument("--output", default=os.path.join("data", "synthetic_flight_weather.csv"), help="Path of the CSV file written")
+    arguments = parser.parse_args()
+    rows = arguments.rows or scales[arguments.scale]
+    print(f"Wrote {rows} rows to {generate(arguments.output, rows, arguments.seed)}")
+
+if __name__ == "__main__":
+    main()
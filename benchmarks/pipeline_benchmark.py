@@ -0,0 +1,201 @@
+'''
+End-to-end benchmark of the three services against a local PostgreSQL. It generates (or reuses) a synthetic flight
+weather CSV, then runs every stage in process, in the order of the flows:
+
+- Data Pipeline: schema, source planning, ingestion, processing and integration (or the streaming stage),
+- Cluster Model: schema, run hand-off, scoring plan, ingestion, clustering, ranking and integration (a full training),
+- an incremental round: rows appended to the CSV, loaded by the Data Pipeline and scored by the Cluster Model,
+- User Interface: the version check, the page rendering and the first and a deep page of the data API,
+- bulk reads: the weekly aggregates read with pandas.read_sql_query over SQLAlchemy (installed for the benchmark only) and
+  with the COPY bulk reader.
+
+For every stage it reports the wall time, the rows handled, the throughput and the peak resident memory sampled while
+the stage ran. The results can be saved as a baseline and later runs compared against it, flagging stages slower than
+the tolerance. The database tables are dropped before the run when --reset is given, so start from an empty database:
+
+    docker run -d --name benchmark-db -p 5432:5432 -e POSTGRES_USER=datapipeline -e POSTGRES_PASSWORD=datapipeline \\
+        -e POSTGRES_DB=database postgres:bullseye
+
+Usage: python benchmarks/pipeline_benchmark.py --host localhost --reset [--scale 1.7M] [--save-baseline benchmarks/baseline.json]
+       python benchmarks/pipeline_benchmark.py --host localhost --reset --baseline benchmarks/baseline.json
+
+'''
+# Importation of libraries
+import os, sys, json, time, shutil, argparse, tempfile, importlib.util
+
+# Make the service modules importable
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+for directory in ["deps", "datapipeline", "cluster-model", "user-interface"]:
+    sys.path.insert(0, os.path.join(root, "src", directory))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import connConfiguration, pipelineConfiguration, stageMetrics, generate_flight_weather
+
+# Function to run a stage, measure it and record its result
+def measure(results, name, function, *args, rows=None):
+    # Sample the peak resident memory of the process while the stage runs, as the services do for their own stages
+    memory = stageMetrics.PeakMemory().start()
+    try:
+        start = time.perf_counter()
+        result = function(*args)
+        seconds = time.perf_counter() - start
+    finally:
+        peak = memory.stop()
+    # Count the rows of the stage from its result when they are not given
+    count = rows(result) if callable(rows) else rows
+    if count is None and hasattr(result, "shape"):
+        count = int(result.shape[0])
+    results[name] = {"seconds": round(seconds, 4), "rows": count, "rows_per_second": round(count / seconds, 1) if count and seconds > 0 else None,
+                     "peak_rss_mb": round(peak, 1) if peak is not None else None}
+    print(f"{name:<42} {seconds:>10.3f} s {count if count is not None else '':>12} rows {f'{peak:.1f}' if peak is not None else '':>10} MB")
+    return result
+
+# Function to import a module from a file whose name is not a valid module name
+def import_path(name, path):
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+# Function to drop the tables of the services, so the benchmark starts from an empty database
+def reset_database(connPool):
+    with connPool.connection() as db_conn, db_conn, db_conn.cursor() as cursor:
+        cursor.execute("DROP SCHEMA public CASCADE; CREATE SCHEMA public;")
+
+# Function to run the Data Pipeline stages over the planned source, counting the streaming stage by the CSV rows read
+def run_data_pipeline(results, data_pipeline, prefix, source_rows):
+    source = measure(results, f"{prefix}.sourceWatermark", data_pipeline.sourceWatermark.run, rows=0)
+    if pipelineConfiguration.ingestion_mode == "streaming":
+        measure(results, f"{prefix}.streamingPipeline", data_pipeline.streamingPipeline.run, source, rows=source_rows)
+        return
+    ingestion = data_pipeline.parallelIngestion if pipelineConfiguration.ingestion_mode == "parallel" else data_pipeline.dataIngestion
+    records = measure(results, f"{prefix}.{ingestion.name}", ingestion.run, source)
+    records = measure(results, f"{prefix}.data_processing", data_pipeline.data_processing.run, records)
+    measure(results, f"{prefix}.data_integration", data_pipeline.data_integration.run, records, source, rows=len(records))
+
+# Function to run the Cluster Model stages for the pending Data Pipeline runs
+def run_cluster_model(results, cluster_model, prefix):
+    runs = measure(results, f"{prefix}.awaitPipelineRun", cluster_model.awaitPipelineRun.run, rows=len)
+    plan = measure(results, f"{prefix}.scoringPlan", cluster_model.scoringPlan.run, rows=0)
+    record = measure(results, f"{prefix}.dataIngestion", cluster_model.dataIngestion.run, plan)
+    model, record = measure(results, f"{prefix}.clusterData", cluster_model.clusterData.run, record, plan, rows=len(record))
+    record = measure(results, f"{prefix}.data_processing", cluster_model.data_processing.run, record, model)
+    measure(results, f"{prefix}.data_integration", cluster_model.data_integration.run, record, model, runs, rows=len(record))
+
+# Function to run the User Interface refresh and page the data API
+def run_user_interface(results, interface, data_api):
+    versions = measure(results, "user-interface.dataVersions", interface.dataVersions.run, rows=0)
+    for task in [interface.message_info, interface.dataPipelineData, interface.clusteredData, interface.originSummary, interface.routeSummary]:
+        measure(results, f"user-interface.{task.name}", task.run, versions, rows=0)
+    # An idle refresh only reads the versions
+    measure(results, "user-interface.idle refresh", lambda: [task.run(versions) for task in [interface.message_info, interface.dataPipelineData]], rows=0)
+    # The first page, then a page deep into the table reached through the cursors
+    page = measure(results, "data-api.flights first page", data_api.fetch_page, "flights", {}, rows=lambda page: len(page["rows"]["tail_num"]))
+    for _ in range(20):
+        if page["next"] is None:
+            break
+        page = data_api.fetch_page("flights", {"after": page["next"]})
+    measure(results, "data-api.flights deep page", data_api.fetch_page, "flights", {"after": page["next"] or ""}, rows=lambda page: len(page["rows"]["tail_num"]))
+    measure(results, "data-api.humidity_rank filtered page", data_api.fetch_page, "humidity_rank", {"rank": "Bad", "sort": "week"},
+            rows=lambda page: len(page["rows"]["tail_num"]))
+
+# Function to read the weekly aggregates with pandas over SQLAlchemy, as the services did before the bulk reader, and with
+# the COPY bulk reader
+def run_bulk_reads(results, cluster_model):
+    import pandas, sqlalchemy, bulkReader
+    engine = sqlalchemy.create_engine(f"postgresql+psycopg2://{connConfiguration.login}:{connConfiguration.pw}@{connConfiguration.host}/{connConfiguration.database}")
+    query = "select aircraft_id, origin_id, dest_id, week, round(humidity_sum / humidity_count, 2) as humidity, load_version from flights_weekly where humidity_count > 0"
+    try:
+        measure(results, "bulk-read.read_sql_query", pandas.read_sql_query, query, engine)
+    finally:
+        engine.dispose()
+    measure(results, "bulk-read.bulkReader", bulkReader.read_query, query, None, cluster_model.weekly_dtype)
+
+# Function to compare the results with a baseline, returning the stages slower than the tolerance
+def compare(results, baseline, tolerance):
+    regressions = []
+    print(f"\n{'stage':<42} {'baseline (s)':>12} {'current (s)':>12} {'change':>8}")
+    for name, result in results.items():
+        reference = baseline.get("stages", {}).get(name)
+        if not reference:
+            continue
+        change = (result["seconds"] - reference["seconds"]) / reference["seconds"] if reference["seconds"] > 0 else 0.0
+        # Ignore the noise of stages too short to measure reliably
+        flagged = change > tolerance and result["seconds"] - reference["seconds"] > 0.05
+        regressions += [name] if flagged else []
+        print(f"{name:<42} {reference['seconds']:>12.3f} {result['seconds']:>12.3f} {change:>+8.1%}{'  REGRESSION' if flagged else ''}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default=connConfiguration.host, help="Host of the PostgreSQL server")
+    parser.add_argument("--scale", choices=list(generate_flight_weather.scales), default="1.7M", help="Preset number of rows")
+    parser.add_argument("--rows", type=int, help="Number of rows, overriding the preset")
+    parser.add_argument("--csv", help="Existing CSV file to load instead of a generated one")
+    parser.add_argument("--append-fraction", type=float, default=0.01, help="Share of rows appended for the incremental round")
+    parser.add_argument("--mode", choices=["streaming", "batch", "parallel"], default=pipelineConfiguration.ingestion_mode, help="Ingestion mode")
+    parser.add_argument("--reset", action="store_true", help="Drop every table of the database before the run")
+    parser.add_argument("--baseline", help="Baseline JSON file to compare the results with")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Slowdown over the baseline flagged as a regression")
+    parser.add_argument("--save-baseline", help="Write the results to this JSON file")
+    arguments = parser.parse_args()
+
+    # Point the services at the benchmark database and the ingestion mode
+    connConfiguration.host = arguments.host
+    pipelineConfiguration.ingestion_mode = arguments.mode
+    import connPool
+    if arguments.reset:
+        reset_database(connPool)
+
+    # Work in a scratch directory holding the CSV and the rendered pages
+    workdir = tempfile.mkdtemp(prefix="pipeline-benchmark-")
+    rows = arguments.rows or generate_flight_weather.scales[arguments.scale]
+    csv = os.path.join(workdir, "flight_weather.csv")
+    if arguments.csv:
+        shutil.copyfile(arguments.csv, csv)
+    else:
+        generate_flight_weather.generate(csv, rows)
+    os.makedirs(os.path.join(workdir, "html-files"))
+
+    # Import the services
+    import data_pipeline, cluster_model, data_api
+    interface = import_path("user_interface_operation", os.path.join(root, "src", "user-interface", "user-interface-operation.py"))
+    data_pipeline.filename = csv
+    cwd = os.getcwd()
+    os.chdir(workdir)
+
+    results = {}
+    try:
+        # Full load and training
+        measure(results, "data-pipeline.initializeSchema", data_pipeline.initializeSchema, rows=0)
+        run_data_pipeline(results, data_pipeline, "data-pipeline", rows)
+        measure(results, "cluster-model.initializeData", cluster_model.initializeData.run, rows=0)
+        run_cluster_model(results, cluster_model, "cluster-model")
+        # Incremental round over appended rows
+        appended = int(rows * arguments.append_fraction)
+        if appended:
+            generate_flight_weather.generate(csv, appended, append_to=rows)
+            run_data_pipeline(results, data_pipeline, "data-pipeline (append)", appended)
+            run_cluster_model(results, cluster_model, "cluster-model (append)")
+        run_user_interface(results, interface, data_api)
+        run_bulk_reads(results, cluster_model)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {"rows": rows, "mode": arguments.mode, "cpus": os.cpu_count(), "stages": results}
+    if arguments.save_baseline:
+        with open(arguments.save_baseline, "w") as handle:
+            json.dump(report, handle, indent=2)
+        print(f"\nBaseline written to {arguments.save_baseline}")
+    if arguments.baseline:
+        with open(arguments.baseline) as handle:
+            baseline = json.load(handle)
+        if baseline.get("rows") != rows or baseline.get("mode") != arguments.mode:
+            print(f"\nThe baseline ran {baseline.get('rows')} rows in {baseline.get('mode')} mode, the comparison is indicative only")
+        regressions = compare(results, baseline, arguments.tolerance)
+        if regressions:
+            print(f"\n{len(regressions)} stage(s) regressed beyond {arguments.tolerance:.0%}")
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
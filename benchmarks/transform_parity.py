@@ -0,0 +1,87 @@
+'''
+Golden-output parity check of the columnar transform engine against the original row-by-row processing stage of the
+data pipeline. The original implementation is kept verbatim below as the golden reference; both run over the same
+records (a built-in edge-case sample, or the real CSV when a path is given) and the loaded rows must be identical.
+
+Usage: python benchmarks/transform_parity.py [--csv data/flight_weather.csv] [--rows N]
+
+'''
+# Importation of libraries
+import os, sys, time, argparse, numpy, pandas
+
+# Make the data pipeline modules importable
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src", "datapipeline"))
+import transform_engine
+
+# Define the specific columns to read only from the CSV file and their data types, as in the data pipeline
+columns_to_read = ["TAIL_NUM", "ORIGIN", "DEST", "MONTH", "DAY_OF_MONTH", "YEAR", "RelativeHumidityOrigin"]
+dtype = {
+    col: "string" if col in ["TAIL_NUM", "ORIGIN", "DEST"] else
+    int if col in ["MONTH", "DAY_OF_MONTH", "YEAR"] else float for col in columns_to_read
+}
+
+# Function holding the original processing stage, the golden reference
+def legacy_processing(records):
+    records = records.drop(records[records.RelativeHumidityOrigin == 'NaN'].index)
+    group_cols = ['TAIL_NUM', 'ORIGIN', 'DEST', 'YEAR', 'MONTH', 'DAY_OF_MONTH']
+    records = records.groupby(group_cols, as_index=False)['RelativeHumidityOrigin'].mean()
+    records['RelativeHumidityOrigin'] = records['RelativeHumidityOrigin'].round(2)
+    def determineWeek(day_of_month):
+        quarters = [1, 2, 3, 4]
+        thresholds = [7, 15, 22, 31]
+        return next((q for q, t in zip(quarters, thresholds) if day_of_month <= t), 4)
+    records['Week'] = records['DAY_OF_MONTH'].apply(determineWeek)
+    records['Date'] = pandas.to_datetime(records[['YEAR', 'MONTH', 'DAY_OF_MONTH']].astype(str).apply(lambda x: '-'.join(x), axis=1))
+    records = records.drop(columns=['YEAR', 'MONTH', 'DAY_OF_MONTH'])
+    records = records.sort_values(by='Date')
+    # The original integration stage skipped the rows without a humidity value
+    return records[records['RelativeHumidityOrigin'].notnull()]
+
+# Function to build a sample covering the edge cases of the processing stage
+def edge_case_sample():
+    days = [1, 7, 8, 15, 16, 22, 23, 28, 31]
+    rows = []
+    for i, day in enumerate(days):
+        # A regular group, a group split across readings and a group with a missing reading
+        rows.append(("N100", "JFK", "LAX", 1, day, 2019, 40.0 + i))
+        rows.append(("N200", "ORD", "SFO", 2 if day <= 28 else 3, day, 2019, 55.125))
+        rows.append(("N200", "ORD", "SFO", 2 if day <= 28 else 3, day, 2019, 60.5))
+        rows.append(("N300", "ATL", "SEA", 12, day, 2018, numpy.nan))
+        rows.append(("N300", "ATL", "SEA", 12, day, 2018, 71.333))
+        # A group whose readings are all missing
+        rows.append(("N400", "DEN", "MIA", 7, day, 2019, numpy.nan))
+    return pandas.DataFrame(rows, columns=columns_to_read).astype(dtype)
+
+# Function to put processed records in a comparable canonical form
+def canonical(records):
+    columns = ['TAIL_NUM', 'ORIGIN', 'DEST', 'Date', 'Week', 'RelativeHumidityOrigin']
+    records = records[columns].sort_values(by=['Date', 'TAIL_NUM', 'ORIGIN', 'DEST']).reset_index(drop=True)
+    # The transform engine keeps the codes dictionary-encoded, compare them as strings
+    return records.astype({'TAIL_NUM': 'string', 'ORIGIN': 'string', 'DEST': 'string', 'Week': 'int64', 'RelativeHumidityOrigin': 'float64'})
+
+# Function to time a processing implementation
+def timed(function, records):
+    start = time.perf_counter()
+    result = function(records.copy())
+    return result, time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--csv", help="CSV file to check instead of the built-in edge-case sample")
+    parser.add_argument("--rows", type=int, default=None, help="Number of CSV rows to read")
+    arguments = parser.parse_args()
+
+    # Load the records to check
+    records = pandas.read_csv(arguments.csv, usecols=columns_to_read, dtype=dtype, nrows=arguments.rows) if arguments.csv else edge_case_sample()
+
+    # Run both implementations
+    golden, legacy_seconds = timed(legacy_processing, records)
+    result, engine_seconds = timed(transform_engine.process_records, records)
+
+    # Compare the loaded rows of both implementations
+    pandas.testing.assert_frame_equal(canonical(result), canonical(golden))
+    print(f"parity ok: {len(golden)} rows from {len(records)} records")
+    print(f"legacy {legacy_seconds:.3f}s, transform engine {engine_seconds:.3f}s, speedup x{legacy_seconds / max(engine_seconds, 1e-9):.1f}")
+
+if __name__ == "__main__":
+    main()
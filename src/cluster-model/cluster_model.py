@@ -4,148 +4,430 @@ whether the humidity level at the origin airport was either good, bad or moderat
 
 '''
 # Importation of the Relevant Libraries
-import time, prefect, datetime, psycopg2, pandas
-import connConfiguration
-from sklearn import cluster as sklearn_cluster
+import time, select, prefect, datetime, numpy, psycopg2.extras
+import connPool, pipelineConfiguration, stageMetrics, bulkLoader, bulkReader, dimensions, clustering_engine
 from prefect import schedules as ps
 from prefect import executors as pe
+from prefect.engine import signals
 
-# Function to create a database connection
-def create_connection():
-    # Establish a connection to the PostgreSQL database using psycopg2 library
-    # and the connection configuration values
-    db_conn = psycopg2.connect(
-        host=connConfiguration.host,   # Specify the host address of the database server
-        dbname=connConfiguration.database,   # Specify the name of the database to connect to
-        user=connConfiguration.login,   # Specify the username for authentication
-        password=connConfiguration.pw   # Specify the password for authentication
-    )
-    # Return the established database connection
-    return db_conn
+# Types of the columns of the weekly aggregates read by the cluster model
+weekly_dtype = {"aircraft_id": "int32", "origin_id": "int16", "dest_id": "int16", "week": "int16", "humidity": "float64", "load_version": "int64"}
+
+# Columns of the ranks stored in 'humidity_rank'
+rank_columns = ["aircraft_id", "origin_id", "dest_id", "week", "humidity", "rank", "partition_label"]
 
 # Function to initialize data
 @prefect.task(max_retries=4, retry_delay=datetime.timedelta(seconds=1))
+@stageMetrics.timed("cluster-model")
 def initializeData():
-    # Establish a database connection using the create_connection() function and create a cursor object
-    with create_connection().cursor() as db_object:
+    # Check a connection out of the pool and create a cursor object
+    with connPool.connection() as db_conn, db_conn.cursor() as db_object:
         try:
-            # Execute a SQL query to create a table named 'humidity_rank' if it doesn't already exist
-            db_object.execute("create table IF NOT EXISTS humidity_rank (tail_num varchar(20), origin varchar(15), dest varchar(15), week int, humidity varchar(20), rank varchar(15));")
-        except:
-            # Rollback the transaction if an exception occurs during the query execution
+            # Execute a SQL query to create the dimension tables of the aircraft and airports and a table named
+            # 'humidity_rank' if they don't already exist, replacing the codes stored by earlier versions with their
+            # surrogate keys, to index the ranks on their key, and to create a table named 'cluster_models' holding the
+            # versioned centroids and rank thresholds of the fitted models and a table named 'cluster_model_partitions'
+            # holding those of the partitions fitted with their own model
+            db_object.execute(dimensions.schema + """
+                create table IF NOT EXISTS humidity_rank (aircraft_id int, origin_id smallint, dest_id smallint, week int, humidity varchar(20), rank varchar(15));
+                alter table humidity_rank add column IF NOT EXISTS partition_label varchar(20);
+                DO $$
+                DECLARE snapshot TEXT;
+                BEGIN
+                    IF EXISTS (SELECT 1 FROM information_schema.columns WHERE table_schema = current_schema() AND table_name = 'humidity_rank' AND column_name = 'tail_num') THEN
+                        INSERT INTO airports (code)
+                        SELECT code FROM (SELECT origin FROM humidity_rank UNION SELECT dest FROM humidity_rank) codes (code)
+                        WHERE code IS NOT NULL AND NOT EXISTS (SELECT 1 FROM airports a WHERE a.code = codes.code) ORDER BY code;
+                        INSERT INTO aircraft (tail_num)
+                        SELECT DISTINCT h.tail_num FROM humidity_rank h
+                        WHERE h.tail_num IS NOT NULL AND NOT EXISTS (SELECT 1 FROM aircraft a WHERE a.tail_num = h.tail_num) ORDER BY 1;
+                        ALTER TABLE humidity_rank ADD COLUMN aircraft_id int, ADD COLUMN origin_id smallint, ADD COLUMN dest_id smallint;
+                        UPDATE humidity_rank h SET aircraft_id = a.aircraft_id, origin_id = o.airport_id, dest_id = d.airport_id
+                        FROM aircraft a, airports o, airports d WHERE a.tail_num = h.tail_num AND o.code = h.origin AND d.code = h.dest;
+                        -- Dropping the code columns drops the indexes on them, they are rebuilt on the surrogate keys below
+                        ALTER TABLE humidity_rank DROP COLUMN tail_num, DROP COLUMN origin, DROP COLUMN dest;
+                        -- The summaries are rebuilt from the ranks, the snapshots of the codes cannot be restored anymore
+                        DROP TABLE IF EXISTS humidity_rank_origin_week, humidity_rank_route, humidity_rank_staging;
+                        FOR snapshot IN SELECT tablename FROM pg_tables WHERE schemaname = current_schema() AND tablename LIKE 'humidity\\_rank\\_snapshot\\_%' LOOP
+                            EXECUTE format('DROP TABLE %I', snapshot);
+                        END LOOP;
+                    END IF;
+                END $$;
+                create index IF NOT EXISTS humidity_rank_key on humidity_rank (aircraft_id, origin_id, dest_id, week);
+                create index IF NOT EXISTS humidity_rank_route_week on humidity_rank (origin_id, dest_id, week);
+                create table IF NOT EXISTS humidity_rank_origin_week (origin_id smallint, week int, rank varchar(15), flights bigint, avg_humidity double precision,
+                    primary key (origin_id, week, rank));
+                create index IF NOT EXISTS humidity_rank_origin_week_rank on humidity_rank_origin_week (week, rank);
+                create table IF NOT EXISTS humidity_rank_route (origin_id smallint, dest_id smallint, good bigint, moderate bigint, bad bigint, flights bigint,
+                    avg_humidity double precision, primary key (origin_id, dest_id));
+                create index IF NOT EXISTS humidity_rank_route_dest on humidity_rank_route (dest_id);
+                create table IF NOT EXISTS cluster_models (version serial primary key, backend varchar(20), centroids double precision[], thresholds double precision[],
+                    ranks varchar(15)[], trained_rows int, scored_version bigint, trained_at timestamp);
+                create table IF NOT EXISTS cluster_model_runs (run_id bigint primary key, processed_at timestamp);
+                alter table cluster_models add column IF NOT EXISTS partition_column varchar(20);
+                alter table cluster_models add column IF NOT EXISTS rank_sums double precision[], add column IF NOT EXISTS rank_counts bigint[];
+                create table IF NOT EXISTS cluster_model_partitions (version int, partition_label varchar(20), centroids double precision[],
+                    thresholds double precision[], trained_rows int, primary key (version, partition_label));
+            """)
+            # Rebuild the summaries when they are missing for stored ranks, as after the migration to surrogate keys
+            db_object.execute("SELECT NOT EXISTS (SELECT 1 FROM humidity_rank_route) AND EXISTS (SELECT 1 FROM humidity_rank)")
+            if db_object.fetchone()[0]:
+                refreshSummaries(db_object)
+            # Commit the changes made to the database
+            db_object.connection.commit()
+        except Exception as error:
+            # Rollback the transaction if an exception occurs during the query execution and let the task retry
             db_object.connection.rollback()
-        # Commit the changes made to the database
-        db_object.connection.commit()
-
-# Function to check a condition
-def check_condition(criteria):
-    # Create a database connection using the 'create_connection' function and use it as a context manager
-    with create_connection() as db_conn:
-        # Create a cursor using the database connection and use it as a context manager
-        with db_conn.cursor() as db_1:
-            # Execute an SQL query to retrieve the latest 'id' from the 'operations' table
-            db_1.execute("SELECT id FROM operations ORDER BY id DESC LIMIT 1")
-            # Fetch the result of the query and return the value of the first column
-            return db_1.fetchone()[0] != criteria
+            print(f"Schema initialization failed: {error}")
+            raise
+
+# Function to list the concluded Data Pipeline runs that have not been processed yet
+def pendingRuns(db_1):
+    # The 'pipeline_runs' table only exists once the Data Pipeline has initialized its schema
+    db_1.execute("SELECT to_regclass('pipeline_runs') IS NOT NULL")
+    if not db_1.fetchone()[0]:
+        return []
+    db_1.execute("SELECT run_id FROM pipeline_runs WHERE run_id > (SELECT coalesce(max(run_id), 0) FROM cluster_model_runs) ORDER BY run_id")
+    return [row[0] for row in db_1.fetchall()]
+
+@prefect.task(max_retries=4, retry_delay=datetime.timedelta(seconds=1))
+@stageMetrics.timed("cluster-model")
+def awaitPipelineRun():
+    # Check a connection out of the pool in autocommit mode, so notifications are delivered while waiting
+    with connPool.connection() as db_conn, db_conn.cursor() as db_1:
+        db_conn.autocommit = True
+        try:
+            # Listen before looking for pending runs, so a run concluding in between is not missed
+            db_1.execute("LISTEN pipeline_runs;")
+            deadline = time.monotonic() + pipelineConfiguration.run_wait_seconds
+            while True:
+                runs = pendingRuns(db_1)
+                if runs:
+                    # Return the runs to process
+                    return runs
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    # Skip the rest of the flow when no run concluded in time, the next scheduled flow run listens again
+                    raise signals.SKIP("No new Data Pipeline run concluded")
+                # Sleep until the Data Pipeline notifies the conclusion of a run or the wait times out
+                if select.select([db_conn], [], [], remaining) != ([], [], []):
+                    db_conn.poll()
+                    db_conn.notifies.clear()
+        finally:
+            # Stop listening before the connection returns to the pool
+            db_1.execute("UNLISTEN pipeline_runs;")
+
+# Function to rebuild the summaries of the ranks per origin and week and per route from the ranks in 'source', only for
+# the origins and routes of the changed keys when a table of changed keys is given. Every ranked key is weighted by the
+# flights of its weekly aggregate, so the summaries count flights and average their humidity instead of averaging keys
+def refreshSummaries(db_object, changed_table=None, source="humidity_rank"):
+    origins = f"AND origin_id IN (SELECT DISTINCT origin_id FROM {changed_table})" if changed_table else ""
+    routes = f"AND (origin_id, dest_id) IN (SELECT DISTINCT origin_id, dest_id FROM {changed_table})" if changed_table else ""
+    db_object.execute(f"""
+        DELETE FROM humidity_rank_origin_week WHERE true {origins};
+        INSERT INTO humidity_rank_origin_week (origin_id, week, rank, flights, avg_humidity)
+        SELECT origin_id, week, r.rank, sum(w.humidity_count), round(sum(w.humidity_sum) / sum(w.humidity_count), 2)
+        FROM {source} r JOIN flights_weekly w USING (aircraft_id, origin_id, dest_id, week)
+        WHERE w.humidity_count > 0 {origins}
+        GROUP BY origin_id, week, r.rank;
+        DELETE FROM humidity_rank_route WHERE true {routes};
+        INSERT INTO humidity_rank_route (origin_id, dest_id, good, moderate, bad, flights, avg_humidity)
+        SELECT origin_id, dest_id, coalesce(sum(w.humidity_count) FILTER (WHERE r.rank = 'Good'), 0), coalesce(sum(w.humidity_count) FILTER (WHERE r.rank = 'Moderate'), 0),
+            coalesce(sum(w.humidity_count) FILTER (WHERE r.rank = 'Bad'), 0), sum(w.humidity_count), round(sum(w.humidity_sum) / sum(w.humidity_count), 2)
+        FROM {source} r JOIN flights_weekly w USING (aircraft_id, origin_id, dest_id, week)
+        WHERE w.humidity_count > 0 {routes}
+        GROUP BY origin_id, dest_id;
+    """)
+
+# Function to bulk load the ranks of a retrained model into a staging table and build its indexes, away from the readers
+# of the live 'humidity_rank' table
+def stageRanks(record):
+    with connPool.connection() as db_conn, db_conn, db_conn.cursor() as db_object:
+        db_object.execute("""
+            DROP TABLE IF EXISTS humidity_rank_staging;
+            CREATE TABLE humidity_rank_staging (LIKE humidity_rank INCLUDING DEFAULTS);
+        """)
+        rows = bulkLoader.copy_dataframe(db_object, "humidity_rank_staging", record[rank_columns], rank_columns)
+        db_object.execute("""
+            CREATE INDEX humidity_rank_staging_key ON humidity_rank_staging (aircraft_id, origin_id, dest_id, week);
+            CREATE INDEX humidity_rank_staging_route_week ON humidity_rank_staging (origin_id, dest_id, week);
+            ANALYZE humidity_rank_staging;
+        """)
+    # Return the number of staged rows
+    return rows
+
+# Function to rename a ranks table and its indexes
+def renameRanks(db_object, table, name):
+    db_object.execute(f"""
+        ALTER TABLE {table} RENAME TO {name};
+        ALTER INDEX {table}_key RENAME TO {name}_key;
+        ALTER INDEX {table}_route_week RENAME TO {name}_route_week;
+    """)
+
+# Function to swap a ranks table in as the live 'humidity_rank' table inside the caller's transaction, keeping the
+# previous live table as the newest snapshot and dropping the snapshots beyond the retention count
+def publishRanks(db_object, table):
+    # Give up rather than queue behind long readers, a waiting rename would block every new reader
+    db_object.execute("SET LOCAL lock_timeout = %s", (f"{pipelineConfiguration.swap_lock_timeout_seconds}s",))
+    retired = f"humidity_rank_snapshot_{datetime.datetime.now():%Y%m%d%H%M%S}"
+    renameRanks(db_object, "humidity_rank", retired)
+    renameRanks(db_object, table, "humidity_rank")
+    # Drop the oldest snapshots, their names sort chronologically
+    db_object.execute("SELECT tablename FROM pg_tables WHERE schemaname = current_schema() AND tablename LIKE 'humidity\\_rank\\_snapshot\\_%' ORDER BY tablename DESC")
+    for (snapshot,) in db_object.fetchall()[pipelineConfiguration.rank_snapshots_kept:]:
+        db_object.execute(f"DROP TABLE {snapshot};")
+    return retired
+
+# Function to roll the live ranks back to the newest snapshot, for instance after a bad retraining:
+# python -c "import cluster_model; cluster_model.restoreSnapshot()"
+def restoreSnapshot():
+    with connPool.connection() as db_conn, db_conn, db_conn.cursor() as db_object:
+        db_object.execute("SELECT max(tablename) FROM pg_tables WHERE schemaname = current_schema() AND tablename LIKE 'humidity\\_rank\\_snapshot\\_%'")
+        snapshot = db_object.fetchone()[0]
+        if snapshot is None:
+            return None
+        # Rebuild the summaries from the snapshot and swap it back in, the rolled back ranks become the newest snapshot
+        refreshSummaries(db_object, source=snapshot)
+        renameRanks(db_object, snapshot, "humidity_rank_restoring")
+        publishRanks(db_object, "humidity_rank_restoring")
+    message_info(f"Ranks rolled back to {snapshot}")
+    return snapshot
+
+# Function to store the scoring progress of the model and mark the runs as processed inside the caller's transaction
+def markProcessed(db_object, record, model, runs):
+    # Remember the latest load version ranked by the model
+    db_object.execute("UPDATE cluster_models SET scored_version = GREATEST(scored_version, %s) WHERE version = %s",
+                      (int(record["load_version"].max()) if len(record) else 0, model["version"]))
+    db_object.execute("INSERT INTO cluster_model_runs (run_id, processed_at) SELECT unnest(%s::bigint[]), now() ON CONFLICT DO NOTHING", (runs,))
 
 # Function to store message information
 def message_info(update):
     # Get the current datetime and format it as a string
     var = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    # Establish a database connection using the create_connection() function
-    db_conn = create_connection()
     # Execute an SQL query to insert the message update and current datetime into the 'operations' table
-    # using a cursor object within a context manager
-    with db_conn, db_conn.cursor() as db_1:
+    # using a pooled connection and a cursor object within a context manager
+    with connPool.connection() as db_conn, db_conn, db_conn.cursor() as db_1:
         db_1.execute("INSERT INTO operations (update, loaddate) VALUES (%s, %s)", (update, var))
 
+# Function to read the latest fitted model
+def latestModel():
+    # Fetch the latest model version with its centroids, rank thresholds, scoring progress and the rank thresholds of its
+    # partitions over a pooled connection
+    with connPool.connection() as db_conn, db_conn, db_conn.cursor() as db_1:
+        db_1.execute("""
+            SELECT version, backend, centroids, thresholds, ranks, scored_version, trained_at, partition_column, rank_sums, rank_counts
+            FROM cluster_models ORDER BY version DESC LIMIT 1
+        """)
+        row = db_1.fetchone()
+        if row is None:
+            return None
+        model = dict(zip(["version", "backend", "centroids", "thresholds", "ranks", "scored_version", "trained_at", "partition_column", "rank_sums",
+                          "rank_counts"], row))
+        db_1.execute("SELECT partition_label, thresholds FROM cluster_model_partitions WHERE version = %s", (model["version"],))
+        model["partitions"] = dict(db_1.fetchall())
+    # Return the model as a dictionary
+    return model
+
+# Function to sum and count the humidity of every key per rank of the global thresholds
+def rankStatistics(humidity, thresholds):
+    positions = numpy.searchsorted(thresholds, humidity, side='right')
+    return (numpy.bincount(positions, humidity, minlength=len(thresholds) + 1).tolist(),
+            numpy.bincount(positions, minlength=len(thresholds) + 1).tolist())
+
+# Function to measure how far the humidity of the current weekly aggregates has drifted from the centroids of a model
+def measureDrift(model):
+    # Average the humidity of each rank of the model thresholds from the running sums and counts kept with the model,
+    # one step of Lloyd's algorithm without reading the weekly aggregates
+    means = {i: total / count for i, (total, count) in enumerate(zip(model["rank_sums"], model["rank_counts"])) if count}
+    # Return the largest distance between a rank mean and its centroid
+    return max((abs(means[i] - centroid) for i, centroid in enumerate(model["centroids"]) if i in means), default=0.0)
+
+# Function to update the running sums and counts of the humidity per rank of a model inside the caller's transaction,
+# with the humidity of the replaced ranks (removed) and of the new ones (added)
+def updateRankStatistics(db_object, model, removed, added):
+    db_object.execute("SELECT rank_sums, rank_counts FROM cluster_models WHERE version = %s FOR UPDATE", (model["version"],))
+    sums, counts = db_object.fetchone()
+    removed_sums, removed_counts = rankStatistics(removed, model["thresholds"])
+    added_sums, added_counts = rankStatistics(added, model["thresholds"])
+    db_object.execute("UPDATE cluster_models SET rank_sums = %s, rank_counts = %s WHERE version = %s", (
+        [total - old + new for total, old, new in zip(sums, removed_sums, added_sums)],
+        [count - old + new for count, old, new in zip(counts, removed_counts, added_counts)], model["version"]))
+
 @prefect.task(max_retries=4, retry_delay=datetime.timedelta(seconds=1))
-def dataIngestion():
-    # Continue looping while the condition is true
-    while check_condition(7):
-        print("Please wait, the datapipeline has NOT been concluded")
-        time.sleep(60)
-    # Log a message indicating the start of data ingestion
-    message_info("Start of Cluster Model Data Ingestion")
-    # Create the engine URL for connecting to the PostgreSQL database
-    engine_url = f'postgresql+psycopg2://{connConfiguration.login}:{connConfiguration.pw}@{connConfiguration.host}/{connConfiguration.database}'
-    # Execute the SQL query and retrieve the results as a pandas DataFrame
-    return pandas.read_sql_query("""
-        select tail_num, origin, dest, week, round(avg(humidity), 2) as humidity
-        from flights
-        group by tail_num, origin, dest, week
-        order by tail_num, origin, dest, week;
-    """, con=engine_url)
+@stageMetrics.timed("cluster-model")
+def scoringPlan():
+    # Read the latest fitted model
+    model = latestModel()
+    # Retrain when there is no model yet, or when it is older than the retraining interval
+    if model is None:
+        return {"mode": "retrain", "reason": "no model", "model": None}
+    if datetime.datetime.now() - model["trained_at"] >= datetime.timedelta(minutes=pipelineConfiguration.retrain_interval_minutes):
+        return {"mode": "retrain", "reason": "scheduled retraining", "model": model}
+    # Retrain when the records are partitioned differently from the stored model
+    if model["partition_column"] != pipelineConfiguration.cluster_partition_column:
+        return {"mode": "retrain", "reason": "partitioning changed", "model": model}
+    # Retrain a model stored without the running sums and counts of its ranks, so its drift can be measured
+    if model["rank_counts"] is None:
+        return {"mode": "retrain", "reason": "no rank statistics", "model": model}
+    # Retrain when the data has drifted away from the centroids
+    drift = measureDrift(model)
+    if drift > pipelineConfiguration.drift_threshold:
+        return {"mode": "retrain", "reason": f"drift of {drift:.2f}", "model": model}
+    # Otherwise only score the keys changed since the last run with the stored thresholds
+    return {"mode": "score", "reason": f"model version {model['version']}", "model": model}
 
 @prefect.task(max_retries=4, retry_delay=datetime.timedelta(seconds=1))
-def clusterData(record):
-    # Drop rows with missing values in the 'humidity' column
-    record.dropna(subset=['humidity'], inplace=True)
-    # Perform K-means clustering on the record DataFrame
-    # Set the number of clusters to 3 and use a fixed random state for reproducibility
-    record['cluster'] = sklearn_cluster.KMeans(n_clusters=3, random_state=42).fit(record.drop(columns=["tail_num","origin","dest"])).labels_
-    # Return the modified record DataFrame
-    return record
+@stageMetrics.timed("cluster-model")
+def dataIngestion(plan):
+    # Log a message indicating the start of data ingestion
+    message_info(f"Start of Cluster Model Data Ingestion ({plan['mode']}, {plan['reason']})")
+    # Read the weekly aggregates maintained by the data pipeline, only the keys changed since the last scoring run when scoring
+    return fetchWeeklyAggregates(plan["model"]["scored_version"] if plan["mode"] == "score" else None)
+
+# Function to read the average weekly humidity of every (aircraft_id, origin_id, dest_id, week) key from the
+# 'flights_weekly' aggregate table, optionally only for the keys loaded after a given load version
+def fetchWeeklyAggregates(since_version=None):
+    # Stream the results of the SQL query into a pandas DataFrame with the bulk reader, the humidity as float64
+    return bulkReader.read_query("""
+        select aircraft_id, origin_id, dest_id, week, round(humidity_sum / humidity_count, 2) as humidity, load_version
+        from flights_weekly
+        where humidity_count > 0 and load_version > %(since_version)s
+        order by aircraft_id, origin_id, dest_id, week
+    """, {"since_version": since_version or 0}, dtype=weekly_dtype)
+
+# Function to read the codes of the airports or aircraft a partition column holds the surrogate keys of
+def partitionNames(column):
+    with connPool.connection() as db_conn, db_conn, db_conn.cursor() as db_1:
+        return dimensions.names(db_1, column)
+
+# Function to compute the rank thresholds of ordered centroids, the midpoints between consecutive centroids
+def rankThresholds(centroids):
+    return [(low + high) / 2 for low, high in zip(centroids, centroids[1:])]
+
+# Function to store a fitted model with its centroids, rank thresholds and the sums and counts of the trained humidity
+# per rank under a new version, together with the centroids and trained rows of the partitions fitted with their own model
+def saveModel(backend, centroids, humidity, partition_column=None, partitions=None):
+    thresholds = rankThresholds(centroids)
+    rank_sums, rank_counts = rankStatistics(humidity, thresholds)
+    partitions = partitions or {}
+    # Insert the model and its partitions and fetch its version over a pooled connection
+    with connPool.connection() as db_conn, db_conn, db_conn.cursor() as db_1:
+        db_1.execute("""
+            INSERT INTO cluster_models (backend, centroids, thresholds, ranks, trained_rows, scored_version, trained_at, partition_column, rank_sums, rank_counts)
+            VALUES (%s, %s, %s, %s, %s, 0, now(), %s, %s, %s) RETURNING version, trained_at
+        """, (backend, centroids, thresholds, ["Good", "Moderate", "Bad"], len(humidity), partition_column, rank_sums, rank_counts))
+        version, trained_at = db_1.fetchone()
+        if partitions:
+            psycopg2.extras.execute_values(db_1, """
+                INSERT INTO cluster_model_partitions (version, partition_label, centroids, thresholds, trained_rows) VALUES %s
+            """, [(version, label, means, rankThresholds(means), rows) for label, (means, rows) in partitions.items()])
+    # Return the model as a dictionary
+    return {"version": version, "backend": backend, "centroids": centroids, "thresholds": thresholds,
+            "ranks": ["Good", "Moderate", "Bad"], "scored_version": 0, "trained_at": trained_at, "partition_column": partition_column,
+            "rank_sums": rank_sums, "rank_counts": rank_counts,
+            "partitions": {label: rankThresholds(means) for label, (means, _) in partitions.items()}}
+
+@prefect.task(max_retries=4, retry_delay=datetime.timedelta(seconds=1), nout=2)
+@stageMetrics.timed("cluster-model")
+def clusterData(record, plan):
+    # Drop rows with missing values in the 'humidity' column, leaving the ingested DataFrame untouched
+    record = record.dropna(subset=['humidity'])
+    # Keep the stored model when only scoring
+    if plan["mode"] == "score":
+        return plan["model"], record
+    # Cluster the record DataFrame into 3 clusters with the configured clustering backend, labelling a new DataFrame
+    record = record.assign(cluster=clustering_engine.fit(record, pipelineConfiguration.cluster_backend, n_clusters=3).labels)
+    # Order the clusters by their mean humidity, the lowest one being 'Good' and the highest one 'Bad', and number them
+    # by that order
+    means = record.groupby('cluster')['humidity'].apply(lambda humidity: humidity.astype(float).mean()).sort_values()
+    record['cluster'] = record['cluster'].map(dict(zip(means.index, range(len(means)))))
+    record['partition_label'] = "global"
+    # Fit the partitions large enough with their own model in parallel, the others keep the ranks of the global model
+    column, partitions = pipelineConfiguration.cluster_partition_column, {}
+    if column:
+        fits = clustering_engine.fit_partitions(record, column, pipelineConfiguration.cluster_backend, n_clusters=3,
+                                                min_rows=pipelineConfiguration.cluster_partition_min_rows, workers=pipelineConfiguration.cluster_workers)
+        # Label the partitions with the codes of their airport or aircraft
+        names = partitionNames(column)
+        clusters, labels = record['cluster'].to_numpy(copy=True), record['partition_label'].to_numpy(dtype=object, copy=True)
+        for key, (rows, positions, partition_means) in fits.items():
+            clusters[rows], labels[rows] = positions, names[key]
+            partitions[names[key]] = (partition_means, len(rows))
+        record['cluster'], record['partition_label'] = clusters, labels
+        message_info(f"Fitted {len(partitions)} partitions by {column}, {int((labels == 'global').sum())} rows ranked by the global model")
+    model = saveModel(pipelineConfiguration.cluster_backend, [float(mean) for mean in means], record['humidity'].to_numpy(dtype=float), column, partitions)
+    model["cluster_ranks"] = dict(enumerate(model["ranks"]))
+    # Return the new model and the records labelled with their cluster and partition
+    return model, record
 
 @prefect.task(max_retries=4, retry_delay=datetime.timedelta(seconds=1))
-def data_processing(record):
-    # Create a DataFrame to store cluster metadata
-    clusterMetadata = pandas.DataFrame({"cluster": [0, 1, 2], "humidity": [record[record.cluster == i]["humidity"].mean() for i in range(3)]})
-    # Sort the cluster metadata DataFrame by the 'humidity' column
-    clusterMetadata = clusterMetadata.sort_values(by='humidity') 
-    # Assign ranks ('Good', 'Moderate', 'Bad') to the cluster metadata DataFrame
-    clusterMetadata['rank'] = ['Good', 'Moderate', 'Bad']
-    # Assign ranks to the 'record' DataFrame based on cluster assignments
-    record['rank'] = record.apply(lambda x: clusterMetadata[clusterMetadata.cluster == x['cluster']]['rank'].iloc[0], axis=1)
-    # Remove the 'cluster' column from the 'record' DataFrame and return the modified DataFrame
-    return record.drop(columns="cluster")
+@stageMetrics.timed("cluster-model")
+def data_processing(record, model):
+    # The records come from clusterData, labelled with their cluster when the model was retrained
+    if 'cluster' in record:
+        # Assign ranks to the training records from their cluster assignments
+        record['rank'] = record['cluster'].map(model["cluster_ranks"])
+        # Remove the 'cluster' column from the 'record' DataFrame
+        record = record.drop(columns="cluster")
+    else:
+        # Assign ranks to the scored records with a vectorized lookup of their humidity in the rank thresholds, those of
+        # their partition when it has its own model
+        humidity = record['humidity'].to_numpy(dtype=float)
+        positions = numpy.searchsorted(model["thresholds"], humidity, side='right')
+        labels = numpy.full(len(record), "global", dtype=object)
+        if model.get("partition_column"):
+            names = partitionNames(model["partition_column"])
+            for key, rows in record.groupby(model["partition_column"]).indices.items():
+                thresholds = model["partitions"].get(names.get(key))
+                if thresholds is not None:
+                    positions[rows], labels[rows] = numpy.searchsorted(thresholds, humidity[rows], side='right'), names[key]
+        record['rank'] = numpy.asarray(model["ranks"])[positions]
+        record['partition_label'] = labels
+    # Return the ranked records
+    return record
 
 @prefect.task(max_retries=4, retry_delay=datetime.timedelta(seconds=1))
-def data_integration(record):
-    # Create a database connection
-    db_conn = create_connection()
-    # Create a database cursor object
-    db_object = db_conn.cursor()
-    # SQL query for inserting data into the 'humidity_rank' table
-    sql = "INSERT INTO humidity_rank (tail_num, origin, dest, week, humidity, rank) VALUES (%s, %s, %s, %s, %s, %s);"
-    # Batch size for executing batch inserts
-    batch_size = 1000
-    # Initialize an empty batch
-    batch = []
-    # Iterate over the rows of the 'record' DataFrame
-    for index, row in record.iterrows():
-        # Extract the values from the current row
-        values = (row[0], row[1], row[2], row[3], row[4], row[5])
-        # Add the values to the batch
-        batch.append(values)
-        # Check if the batch size has been reached
-        if len(batch) >= batch_size:
-            # Execute the batch insert
-            execute_batch_insert(db_object, sql, batch)
-            # Reset the batch
-            batch = []
-    # Check if there are remaining values in the batch
-    if len(batch) > 0:
-        # Execute the remaining batch insert
-        execute_batch_insert(db_object, sql, batch)
-    # Commit the changes to the database
-    db_conn.commit()
-    # Close the database connection
-    db_conn.close()
+@stageMetrics.timed("cluster-model")
+def data_integration(record, model, runs):
+    # Record the start time of the load
+    start = time.perf_counter()
+    if 'cluster_ranks' in model:
+        # A retrained model ranks every key: its ranks are loaded and indexed in a staging table first
+        rows = stageRanks(record)
+        # Then the summaries are rebuilt from the staging table, the staging table is swapped in as the live table, the
+        # scoring progress is stored and the runs are marked as processed in one short transaction
+        with connPool.connection() as db_conn, db_conn, db_conn.cursor() as db_object:
+            refreshSummaries(db_object, source="humidity_rank_staging")
+            publishRanks(db_object, "humidity_rank_staging")
+            markProcessed(db_object, record, model, runs)
+    else:
+        # Replace the ranks of the changed keys and their summaries, store the scoring progress of the model and mark the
+        # runs as processed in a single transaction
+        with connPool.connection() as db_conn, db_conn, db_conn.cursor() as db_object:
+            # Scoring only replaces the ranks of the changed keys
+            db_object.execute("CREATE TEMP TABLE humidity_rank_changes (LIKE humidity_rank) ON COMMIT DROP;")
+            rows = bulkLoader.copy_dataframe(db_object, "humidity_rank_changes", record[rank_columns], rank_columns)
+            db_object.execute("""
+                DELETE FROM humidity_rank h USING humidity_rank_changes c
+                WHERE h.aircraft_id = c.aircraft_id AND h.origin_id = c.origin_id AND h.dest_id = c.dest_id AND h.week = c.week
+                RETURNING h.humidity::double precision;
+            """)
+            removed = numpy.array([row[0] for row in db_object.fetchall() if row[0] is not None], dtype=float)
+            db_object.execute("INSERT INTO humidity_rank SELECT * FROM humidity_rank_changes;")
+            # Move the humidity of the replaced keys to their new ranks in the running sums and counts of the model
+            updateRankStatistics(db_object, model, removed, record['humidity'].to_numpy(dtype=float))
+            # Build the summaries in full the first time, then only for the origins and routes of the changed keys
+            db_object.execute("SELECT EXISTS (SELECT 1 FROM humidity_rank_route)")
+            refreshSummaries(db_object, "humidity_rank_changes" if db_object.fetchone()[0] else None)
+            markProcessed(db_object, record, model, runs)
+    report = bulkLoader.LoadReport("humidity_rank", rows, time.perf_counter() - start)
+    stageMetrics.current().rows_out = report.rows
     # Log a message indicating the conclusion of data integration
-    message_info("Data Integration Concluded")
+    message_info(f"Data Integration of {report.rows} rows concluded ({report.rows_per_second:.0f} rows/s)")
     message_info("All data engineering processes concluded.")
     # Return a string indicating the completion of the task
     return "Done"
 
-def execute_batch_insert(cursor, sql, values_batch):
-    try:
-        # Execute the batch insert using the executemany() method of the cursor
-        cursor.executemany(sql, values_batch)
-    except:
-        # If an exception occurs during the batch insert, roll back the changes
-        cursor.connection.rollback()
-
 def main():
     # Define the interval for the schedule
     interval = datetime.timedelta(minutes=2) 
@@ -157,15 +439,19 @@ def main():
     # Create a Prefect flow with the name "cluster-model" and the defined schedule
     with prefect.Flow("cluster-model", schedule=schedule) as flow:
         # Task: initializeData
-        initializeData() 
+        schema = initializeData()
+        # Task: awaitPipelineRun, waiting for the Data Pipeline to notify the conclusion of a run not processed yet
+        runs = awaitPipelineRun(upstream_tasks=[schema])
+        # Task: scoringPlan, deciding between full retraining and scoring the changed keys
+        plan = scoringPlan(upstream_tasks=[runs])
         # Task: dataIngestion
-        record = dataIngestion()
-        # Task: clusterData
-        record = clusterData(record)
+        record = dataIngestion(plan)
+        # Task: clusterData, returning the model and the records it labelled
+        model, record = clusterData(record, plan)
         # Task: data_processing
-        record = data_processing(record)
+        record = data_processing(record, model)
         # Task: data_integration
-        data_integration(record)
+        data_integration(record, model, runs)
     # Run the Prefect flow using a local Dask executor
     flow.run(executor=pe.LocalDaskExecutor())
 
@@ -0,0 +1,200 @@
+'''
+The clustering engine groups the weekly humidity records into clusters through a pluggable backend:
+
+- kmeans: the original scikit-learn KMeans over the week and humidity columns, re-fitted from scratch on every run.
+- optimal1d: exact (globally optimal) 1-D k-means, also known as Jenks natural breaks, over the humidity column. The
+  humidity values are binned into their distinct values (they carry 2 decimals), so after an O(n log n) sort the
+  dynamic programme only runs over the distinct values and always returns the same boundaries for the same data.
+- minibatch: scikit-learn MiniBatchKMeans over the week and humidity columns, warm-started from the centroids of the
+  previous run, for large inputs.
+
+Every backend returns the cluster label of each record together with the centroids of the clusters over the features
+it fitted. `python benchmarks/clustering_benchmark.py` compares their runtime and assignment stability.
+
+The records may also be partitioned by a column (the origin airport for instance), every partition large enough being
+fitted with its own model, so the ranks follow the local climate of each airport. The exact 1-D fits of all the
+partitions run as one vectorized programme, the other backends fit the partitions in a pool of worker processes.
+
+'''
+# Importation of libraries
+import collections, multiprocessing, numpy
+from concurrent import futures
+import workerPool
+
+# Result of a fit: the cluster label of every record and the centroids of the clusters over the fitted features
+ClusterFit = collections.namedtuple("ClusterFit", ["labels", "centroids", "features"])
+
+# Centroids of the previous run per backend, used to warm-start the minibatch backend
+previous_centroids = {}
+
+# Function to compute the within-cluster sum of squares of the distinct values in [i, j) from prefix sums,
+# 'i' may be an array of start positions
+def segment_cost(weights, sums, squares, i, j):
+    weight = weights[j] - weights[i]
+    total = sums[j] - sums[i]
+    return numpy.where(weight > 0, squares[j] - squares[i] - total * total / numpy.maximum(weight, 1e-300), 0.0)
+
+# Function to fill one layer of the dynamic programme with the divide and conquer optimization, evaluating all the
+# nodes of a level of the recursion in one vectorized pass instead of one Python iteration per end position
+def fill_layer(previous, current, argmin, prefix, low, high, opt_low, opt_high):
+    lows, highs, opt_lows, opt_highs = (numpy.atleast_1d(bound) for bound in (low, high, opt_low, opt_high))
+    while len(lows):
+        middles = (lows + highs) // 2
+        # The last cluster of a node covers the distinct values in [split, middle), lay the candidate splits of every
+        # node out one after the other, every split leaving at least one distinct value to the last cluster
+        counts = numpy.minimum(middles - 1, opt_highs) - opt_lows + 1
+        starts = numpy.concatenate([[0], numpy.cumsum(counts)[:-1]])
+        candidates = numpy.arange(counts.sum()) + numpy.repeat(opt_lows - starts, counts)
+        weights, sums, squares, costs = (column[candidates] for column in prefix + (previous,))
+        end_weights, end_sums, end_squares = (numpy.repeat(column[middles], counts) for column in prefix)
+        total = end_sums - sums
+        costs += end_squares - squares - total * total / (end_weights - weights)
+        # Keep the first candidate reaching the minimum of its node, as argmin does
+        best = numpy.minimum.reduceat(costs, starts)
+        first = numpy.flatnonzero(costs == numpy.repeat(best, counts))
+        nodes = numpy.searchsorted(starts, first, side="right") - 1
+        best_splits = candidates[first[numpy.concatenate([[True], nodes[1:] != nodes[:-1]])]]
+        current[middles], argmin[middles] = best, best_splits
+        # The optimal split is monotone in the end position, so both halves of every node search a narrower range
+        lows, highs = numpy.concatenate([lows, middles + 1]), numpy.concatenate([middles - 1, highs])
+        opt_lows, opt_highs = numpy.concatenate([opt_lows, best_splits]), numpy.concatenate([best_splits, opt_highs])
+        keep = lows <= highs
+        lows, highs, opt_lows, opt_highs = lows[keep], highs[keep], opt_lows[keep], opt_highs[keep]
+
+# Function to find the optimal 1-D k-means boundaries over weighted distinct values, of several independent problems
+# at once when 'offsets' gives the position of the first distinct value of every problem laid out one after the other
+def optimal_breaks(values, weights, n_clusters, offsets=None):
+    single = offsets is None
+    offsets = numpy.zeros(1, dtype=int) if single else numpy.asarray(offsets, dtype=int)
+    sizes = numpy.diff(numpy.append(offsets, len(values)))
+    # Every problem owns one more prefix position than distinct values, its prefix sums starting from 0
+    starts = offsets + numpy.arange(len(offsets))
+    problem = numpy.repeat(numpy.arange(len(offsets)), sizes + 1)
+    position = offsets[problem] + numpy.arange(len(problem)) - starts[problem]
+    prefix = tuple(numpy.concatenate([[0.0], numpy.cumsum(column)])[position] - numpy.concatenate([[0.0], numpy.cumsum(column)])[offsets[problem]]
+                   for column in (weights, weights * values, weights * values * values))
+    # Cost of a single cluster covering the first j distinct values of every problem
+    previous = segment_cost(*prefix, starts[problem], numpy.arange(len(problem)))
+    splits = []
+    for k in range(2, n_clusters + 1):
+        current, argmin = numpy.full(len(problem), numpy.inf), numpy.zeros(len(problem), dtype=int)
+        # The last layer is only walked back from the last distinct value, every other end position is skipped
+        first_end = starts + sizes if k == n_clusters else starts + k
+        fill_layer(previous, current, argmin, prefix, first_end, starts + sizes, starts + k - 1, starts + sizes - 1)
+        previous = current
+        splits.append(argmin)
+    # Walk the splits back from the last distinct value of every problem
+    breaks, end = [], starts + sizes
+    for argmin in reversed(splits):
+        end = argmin[end]
+        breaks.append(end - starts)
+    # Return the index of the first distinct value of every cluster after the first, per problem
+    breaks = numpy.array(breaks[::-1], dtype=int).reshape(n_clusters - 1, len(offsets)).T
+    return sorted(breaks[0]) if single else breaks
+
+# Function to cluster the humidity column with exact 1-D k-means
+def fit_optimal1d(record, n_clusters):
+    humidity = record["humidity"].to_numpy(dtype=float)
+    # Bin the humidity into its distinct values with their counts
+    values, inverse, counts = numpy.unique(humidity, return_inverse=True, return_counts=True)
+    n_clusters = min(n_clusters, len(values))
+    breaks = optimal_breaks(values, counts.astype(float), n_clusters)
+    # Label every distinct value with its cluster, clusters are numbered by ascending humidity
+    value_labels = numpy.searchsorted(numpy.asarray(breaks), numpy.arange(len(values)), side="right")
+    labels = value_labels[inverse]
+    centroids = numpy.array([[numpy.average(values[value_labels == c], weights=counts[value_labels == c])] for c in range(n_clusters)])
+    return ClusterFit(labels, centroids, ["humidity"])
+
+# Function to cluster the week and humidity columns with the original KMeans
+def fit_kmeans(record, n_clusters):
+    # scikit-learn is imported on first use, so the workers fitting partitions with the optimal1d backend start quickly
+    from sklearn import cluster as sklearn_cluster
+    model = sklearn_cluster.KMeans(n_clusters=n_clusters, random_state=42).fit(record[["week", "humidity"]])
+    return ClusterFit(model.labels_, model.cluster_centers_, ["week", "humidity"])
+
+# Function to cluster the week and humidity columns with MiniBatchKMeans, warm-started from the previous centroids
+def fit_minibatch(record, n_clusters):
+    from sklearn import cluster as sklearn_cluster
+    init = previous_centroids.get("minibatch")
+    warm = init is not None and init.shape == (n_clusters, 2)
+    model = sklearn_cluster.MiniBatchKMeans(n_clusters=n_clusters, init=init if warm else "k-means++", n_init=1 if warm else 3,
+                                            batch_size=4096, random_state=42).fit(record[["week", "humidity"]].to_numpy(dtype=float))
+    return ClusterFit(model.labels_, model.cluster_centers_, ["week", "humidity"])
+
+# Available clustering backends
+backends = {"kmeans": fit_kmeans, "optimal1d": fit_optimal1d, "minibatch": fit_minibatch}
+
+# Function to cluster the records with the chosen backend
+def fit(record, backend, n_clusters=3):
+    result = backends[backend](record, n_clusters)
+    # Keep the centroids to warm-start the next run
+    previous_centroids[backend] = numpy.asarray(result.centroids, dtype=float)
+    return result
+
+# Function run by a worker to fit the records of one partition, returning the rank position of every record (the
+# clusters numbered by ascending mean humidity) with the ordered cluster means, or None when the partition does not
+# separate into every cluster
+def fit_partition(label, record, backend, n_clusters):
+    labels = numpy.asarray(backends[backend](record, n_clusters).labels)
+    clusters = numpy.unique(labels)
+    if len(clusters) < n_clusters:
+        return label, None, None
+    humidity = record["humidity"].to_numpy(dtype=float)
+    means = numpy.array([humidity[labels == cluster].mean() for cluster in clusters])
+    positions = numpy.empty(len(clusters), dtype=int)
+    positions[numpy.argsort(means)] = numpy.arange(len(clusters))
+    return label, positions[numpy.searchsorted(clusters, labels)], numpy.sort(means).tolist()
+
+# Function to fit the humidity of every partition (the row positions of the records by label) with exact 1-D k-means
+# in one vectorized pass over all the partitions, returning the label, rank positions and ordered cluster means of every
+# partition as fit_partition does
+def fit_optimal1d_partitions(record, groups, n_clusters):
+    labels, rows = list(groups), list(groups.values())
+    sizes = numpy.array([len(part) for part in rows])
+    problem = numpy.repeat(numpy.arange(len(rows)), sizes)
+    humidity = record["humidity"].to_numpy(dtype=float)[numpy.concatenate(rows)]
+    # Bin the humidity of every partition into its distinct values with their counts
+    order = numpy.lexsort((humidity, problem))
+    first = numpy.ones(len(order), dtype=bool)
+    first[1:] = (numpy.diff(problem[order]) != 0) | (numpy.diff(humidity[order]) != 0)
+    inverse = numpy.empty(len(order), dtype=int)
+    inverse[order] = numpy.cumsum(first) - 1
+    values, value_problem, counts = humidity[order][first], problem[order][first], numpy.bincount(inverse)
+    # Solve the partitions holding at least one distinct value per cluster, the others cannot separate into every cluster
+    distinct = numpy.bincount(value_problem, minlength=len(rows))
+    solved = distinct >= n_clusters
+    kept = solved[value_problem]
+    offsets = numpy.concatenate([[0], numpy.cumsum(distinct[solved])[:-1]])
+    breaks = numpy.empty((len(rows), n_clusters - 1), dtype=int)
+    breaks[solved] = optimal_breaks(values[kept], counts[kept].astype(float), n_clusters, offsets)
+    # Label every distinct value with its cluster, clusters are numbered by ascending humidity
+    value_offsets = numpy.concatenate([[0], numpy.cumsum(distinct)[:-1]])
+    index = numpy.arange(len(values)) - value_offsets[value_problem]
+    value_labels = (index[:, None] >= breaks[value_problem]).sum(axis=1)
+    cluster = value_problem * n_clusters + value_labels
+    means = (numpy.bincount(cluster, values * counts, minlength=len(rows) * n_clusters)
+             / numpy.maximum(numpy.bincount(cluster, counts, minlength=len(rows) * n_clusters), 1)).reshape(len(rows), n_clusters)
+    positions = numpy.split(value_labels[inverse], numpy.cumsum(sizes)[:-1])
+    return [(label, positions[i], means[i].tolist()) if solved[i] else (label, None, None) for i, label in enumerate(labels)]
+
+# Function to fit every partition of the records (grouped by 'column') holding at least 'min_rows' rows with its own
+# model in a pool of worker processes, returning the row positions, rank positions and ordered cluster means of every
+# fitted partition by label, the other partitions are left to the global model
+def fit_partitions(record, column, backend, n_clusters=3, min_rows=500, workers=None):
+    groups = {label: rows for label, rows in record.groupby(column, sort=True).indices.items() if len(rows) >= min_rows}
+    if backend == "optimal1d" and groups:
+        # The exact 1-D fit of all the partitions runs as one vectorized programme, cheaper than any worker round trip
+        results = fit_optimal1d_partitions(record, groups, n_clusters)
+        return {label: (groups[label], positions, means) for label, positions, means in results if positions is not None}
+    features = ["humidity"] if backend == "optimal1d" else ["week", "humidity"]
+    jobs = [(label, record[features].iloc[rows].reset_index(drop=True), backend, n_clusters) for label, rows in groups.items()]
+    # Default to the CPUs available to the process
+    workers = min(workers or workerPool.available_cpus(), len(jobs))
+    if workers > 1:
+        # Fit the partitions in worker processes started with 'spawn', as the flow runs inside a threaded executor, and
+        # hand them out in batches so the many small airports do not pay one round trip each
+        with futures.ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+            results = list(pool.map(fit_partition, *zip(*jobs), chunksize=max(1, len(jobs) // (workers * 4))))
+    else:
+        results = [fit_partition(*job) for job in jobs]
+    return {label: (groups[label], positions, means) for label, positions, means in results if positions is not None}
@@ -0,0 +1,136 @@
+'''
+The columnar cache keeps the parsed, typed columns of the CSV source next to it, so a later full read of an unchanged
+file skips CSV parsing altogether. A snapshot is keyed by the path, size, modification time and content fingerprint
+(head and tail hashes) of the source, so a changed source never hits a stale snapshot. Every snapshot is a directory of
+segments holding one NumPy array per column: numeric columns are memory-mapped zero-copy, string columns are stored
+dictionary-encoded as integer codes plus their categories. Only the newest snapshots are kept.
+
+With incremental ingestion an unchanged source is not read at all, an appended one is read from its watermark and a
+rewritten one gets a new key, so snapshots are only used by full refreshes, which reload the whole source every run.
+
+'''
+# Importation of libraries
+import os, json, shutil, hashlib, numpy, pandas
+import pipelineConfiguration
+
+# Version of the snapshot layout, part of the snapshot key
+layout_version = 1
+
+# Function to get the size (in bytes) of the parsed rows buffered before they are written as a segment, a share of the
+# memory budget of the ingestion
+def segment_bytes():
+    return pipelineConfiguration.memory_budget_mb * 1048576 // 8
+
+# Function to get the cache directory of a source file
+def cache_directory(plan):
+    return plan["source"] + ".cache"
+
+# Function to get the snapshot directory of the planned source
+def snapshot_path(plan):
+    # Key the snapshot by the path, size, modification time and content fingerprint of the source
+    key = f"{os.path.abspath(plan['source'])}|{plan['size']}|{plan['mtime']}|{plan['head_hash']}|{plan['tail_hash']}|{layout_version}"
+    return os.path.join(cache_directory(plan), hashlib.sha256(key.encode("utf-8")).hexdigest()[:24])
+
+# Function to find the complete snapshot of the planned source
+def lookup(plan):
+    path = snapshot_path(plan)
+    if not os.path.exists(os.path.join(path, "meta.json")):
+        return None
+    # Mark the snapshot as recently used for the eviction policy
+    os.utime(path)
+    return path
+
+# Function to read the columns of a segment, memory-mapping the numeric ones
+def read_segment(path, meta):
+    columns = {}
+    for name, kind in meta["columns"].items():
+        if kind == "category":
+            codes = numpy.load(os.path.join(path, f"{name}.codes.npy"), mmap_mode="r")
+            categories = numpy.load(os.path.join(path, f"{name}.categories.npy"))
+            columns[name] = pandas.Categorical.from_codes(codes, categories)
+        else:
+            columns[name] = numpy.load(os.path.join(path, f"{name}.npy"), mmap_mode="r")
+    return pandas.DataFrame(columns, copy=False)
+
+# Function to iterate over the rows of a snapshot in chunks
+def iter_chunks(path, chunksize):
+    with open(os.path.join(path, "meta.json")) as handle:
+        meta = json.load(handle)
+    for segment in meta["segments"]:
+        frame = read_segment(os.path.join(path, segment), meta)
+        # Hand out views of the segment, so chunks stay zero-copy
+        for start in range(0, len(frame), chunksize):
+            yield frame.iloc[start:start + chunksize]
+
+# Function to write a dataframe as a segment of a snapshot
+def write_segment(path, frame):
+    os.makedirs(path)
+    kinds = {}
+    for name in frame.columns:
+        column = frame[name]
+        if not pandas.api.types.is_numeric_dtype(column.dtype):
+            # Store string columns as integer codes into their categories
+            encoded = pandas.Categorical(column)
+            numpy.save(os.path.join(path, f"{name}.codes.npy"), encoded.codes.astype(numpy.int32))
+            numpy.save(os.path.join(path, f"{name}.categories.npy"), numpy.asarray(encoded.categories, dtype=str))
+            kinds[name] = "category"
+        else:
+            numpy.save(os.path.join(path, f"{name}.npy"), column.to_numpy())
+            kinds[name] = str(column.dtype)
+    return kinds
+
+# Writer of a snapshot, filled chunk by chunk and published atomically by renaming its temporary directory
+class SnapshotWriter:
+    def __init__(self, plan, prefix="segment", reset=True):
+        self.path = snapshot_path(plan)
+        self.temporary = self.path + ".tmp"
+        self.prefix = prefix
+        self.kinds = {}
+        self.segments = []
+        self._pending = []
+        self._pending_bytes = 0
+        # Start from an empty temporary directory, unless other writers share it
+        if reset:
+            shutil.rmtree(self.temporary, ignore_errors=True)
+        os.makedirs(self.temporary, exist_ok=True)
+
+    # Function to add a chunk of parsed rows to the snapshot
+    def append(self, chunk):
+        self._pending.append(chunk)
+        self._pending_bytes += int(chunk.memory_usage(index=False, deep=True).sum())
+        if self._pending_bytes >= segment_bytes():
+            self.flush()
+
+    # Function to write the pending chunks as a segment
+    def flush(self):
+        if self._pending:
+            name = f"{self.prefix}-{len(self.segments):05d}"
+            self.kinds = write_segment(os.path.join(self.temporary, name), pandas.concat(self._pending, ignore_index=True))
+            self.segments.append(name)
+            self._pending, self._pending_bytes = [], 0
+        return self.segments
+
+    # Function to publish the snapshot, optionally with segments written by other writers of the same snapshot
+    def commit(self, segments=None, kinds=None):
+        self.flush()
+        with open(os.path.join(self.temporary, "meta.json"), "w") as handle:
+            json.dump({"columns": kinds or self.kinds, "segments": sorted(segments if segments is not None else self.segments)}, handle)
+        shutil.rmtree(self.path, ignore_errors=True)
+        os.rename(self.temporary, self.path)
+
+    # Function to discard the snapshot
+    def abort(self):
+        shutil.rmtree(self.temporary, ignore_errors=True)
+
+# Function to remove all but the newest snapshots of a source
+def evict(plan, keep):
+    directory = cache_directory(plan)
+    if not os.path.isdir(directory):
+        return []
+    # Order the complete snapshots from newest to oldest use
+    snapshots = sorted((os.path.join(directory, name) for name in os.listdir(directory) if not name.endswith(".tmp")), key=os.path.getmtime, reverse=True)
+    # Remove the snapshots beyond the retention count
+    evicted = snapshots[keep:]
+    for path in evicted:
+        shutil.rmtree(path, ignore_errors=True)
+    return evicted
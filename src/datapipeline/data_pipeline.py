@@ -6,127 +6,351 @@ their origin airports.
 
 '''
 # Importation of libraries 
-import prefect, datetime, psycopg2, pandas
+import prefect, datetime, time, pandas
 from prefect import schedules as ps
 from prefect import executors as pe
-from psycopg2 import extras as db
-import connConfiguration
+import connPool, pipelineConfiguration, stageMetrics, workerPool, bulkLoader, dimensions, source_reader, transform_engine, parallel_ingestion, columnar_cache
 
-# Function to create a database connection
-def create_connection():
-    return psycopg2.connect(f"host='{connConfiguration.host}' dbname='{connConfiguration.database}' user='{connConfiguration.login}' password='{connConfiguration.pw}'")
+# Define the specific columns to read only from the CSV file
+columns_to_read = ["TAIL_NUM", "ORIGIN", "DEST", "MONTH", "DAY_OF_MONTH", "YEAR", "RelativeHumidityOrigin"]
 
-# Function to close the database connection
-def close_connection(db_conn):
-    db_conn.close()
+# Define the data types for the columns, the codes being dictionary-encoded as categoricals
+dtype = {
+    col: "category" if col in ["TAIL_NUM", "ORIGIN", "DEST"] else
+    int if col in ["MONTH", "DAY_OF_MONTH", "YEAR"] else float for col in columns_to_read
+}
+
+# Define the filename of the source CSV file
+filename = "datapipeline/flight_weather.csv"
+
+# Define the natural key of the 'flights' table, made of the surrogate keys of the aircraft and airports
+natural_key = ["aircraft_id", "origin_id", "dest_id", "date"]
 
 # Function to initialize the database schema
+@stageMetrics.timed("data-pipeline")
 def initializeSchema():
-    # Create a cursor object using the connection
-    currentVar = create_connection().cursor()
-    # SQL statement to create tables if they don't already exist
-    postgreSQL = "CREATE TABLE IF NOT EXISTS flights (tail_num VARCHAR(30), origin VARCHAR(25), dest VARCHAR(25), week INT, date DATE, humidity DECIMAL); CREATE TABLE IF NOT EXISTS operations (id SERIAL, update VARCHAR(400), loaddate TIMESTAMP);"
-    try:
-        # Execute the SQL statement
-        currentVar.execute(postgreSQL)
-        
-        # Commit the changes to the database
-        currentVar.connection.commit()
-    except:
-        # Rollback the changes if an error occurs
-        currentVar.connection.rollback()
-    # Close the database connection
-    currentVar.connection.close()
+    # SQL statement to create the dimension tables and the tables if they don't already exist, to back the upsert path
+    # with a unique index on the natural key, removing duplicates of earlier appends first, to move an unpartitioned
+    # 'flights' table into monthly range partitions on date, and to replace the codes of the aircraft and airports stored
+    # by earlier versions with their surrogate keys
+    postgreSQL = dimensions.schema + """
+        CREATE TABLE IF NOT EXISTS flights (aircraft_id INT, origin_id SMALLINT, dest_id SMALLINT, week INT, date DATE, humidity DECIMAL,
+            humidity_sum DOUBLE PRECISION, humidity_count INT) PARTITION BY RANGE (date);
+        ALTER TABLE flights ADD COLUMN IF NOT EXISTS humidity_sum DOUBLE PRECISION, ADD COLUMN IF NOT EXISTS humidity_count INT;
+        CREATE OR REPLACE FUNCTION flights_ensure_partitions(first_day DATE, last_day DATE) RETURNS void AS $$
+        DECLARE month DATE;
+        BEGIN
+            FOR month IN SELECT generate_series(date_trunc('month', first_day), date_trunc('month', last_day), interval '1 month')::date LOOP
+                EXECUTE format('CREATE TABLE IF NOT EXISTS %I PARTITION OF flights FOR VALUES FROM (%L) TO (%L)',
+                               'flights_' || to_char(month, 'YYYYMM'), month, (month + interval '1 month')::date);
+            END LOOP;
+        END $$ LANGUAGE plpgsql;
+        CREATE OR REPLACE FUNCTION flights_has_codes(relation TEXT) RETURNS boolean AS $$
+            SELECT EXISTS (SELECT 1 FROM information_schema.columns WHERE table_schema = current_schema() AND table_name = relation AND column_name = 'tail_num');
+        $$ LANGUAGE sql;
+        CREATE TABLE IF NOT EXISTS operations (id SERIAL, update VARCHAR(400), loaddate TIMESTAMP);
+        DO $$ BEGIN
+            IF flights_has_codes('flights_partial') THEN
+                DROP TABLE flights_partial;
+            END IF;
+        END $$;
+        CREATE UNLOGGED TABLE IF NOT EXISTS flights_partial (aircraft_id INT, origin_id SMALLINT, dest_id SMALLINT, week INT, date DATE, humidity_sum DOUBLE PRECISION, humidity_count INT);
+        CREATE TABLE IF NOT EXISTS source_watermark (source VARCHAR(400) PRIMARY KEY, size BIGINT, mtime DOUBLE PRECISION, head_hash VARCHAR(64), tail_hash VARCHAR(64), byte_offset BIGINT, loaddate TIMESTAMP);
+        ALTER TABLE source_watermark ADD COLUMN IF NOT EXISTS plan_id VARCHAR(32);
+        DO $$ BEGIN
+            IF to_regclass('flights_natural_key') IS NULL AND flights_has_codes('flights') THEN
+                UPDATE flights SET humidity_sum = humidity, humidity_count = 1 WHERE humidity_count IS NULL;
+                DELETE FROM flights a USING flights b WHERE a.ctid < b.ctid AND a.tail_num = b.tail_num AND a.origin = b.origin AND a.dest = b.dest AND a.date = b.date;
+                CREATE UNIQUE INDEX flights_natural_key ON flights (tail_num, origin, dest, date);
+            END IF;
+        END $$;
+        DO $$ BEGIN
+            IF (SELECT relkind FROM pg_class WHERE oid = 'flights'::regclass) = 'r' THEN
+                ALTER TABLE flights RENAME TO flights_unpartitioned;
+                ALTER INDEX flights_natural_key RENAME TO flights_unpartitioned_natural_key;
+                ALTER INDEX IF EXISTS flights_route_week RENAME TO flights_unpartitioned_route_week;
+                CREATE TABLE flights (LIKE flights_unpartitioned) PARTITION BY RANGE (date);
+                CREATE UNIQUE INDEX flights_natural_key ON flights (tail_num, origin, dest, date);
+                PERFORM flights_ensure_partitions(min(date), max(date)) FROM flights_unpartitioned;
+                INSERT INTO flights SELECT * FROM flights_unpartitioned WHERE date IS NOT NULL;
+                DROP TABLE flights_unpartitioned;
+            END IF;
+        END $$;
+        DO $$ BEGIN
+            IF flights_has_codes('flights') THEN
+                INSERT INTO airports (code)
+                SELECT code FROM (SELECT origin FROM flights UNION SELECT dest FROM flights) codes (code)
+                WHERE code IS NOT NULL AND NOT EXISTS (SELECT 1 FROM airports a WHERE a.code = codes.code) ORDER BY code;
+                INSERT INTO aircraft (tail_num)
+                SELECT DISTINCT f.tail_num FROM flights f
+                WHERE f.tail_num IS NOT NULL AND NOT EXISTS (SELECT 1 FROM aircraft a WHERE a.tail_num = f.tail_num) ORDER BY 1;
+                ALTER TABLE flights ADD COLUMN aircraft_id INT, ADD COLUMN origin_id SMALLINT, ADD COLUMN dest_id SMALLINT;
+                UPDATE flights f SET aircraft_id = a.aircraft_id, origin_id = o.airport_id, dest_id = d.airport_id
+                FROM aircraft a, airports o, airports d WHERE a.tail_num = f.tail_num AND o.code = f.origin AND d.code = f.dest;
+                -- Dropping the code columns drops the indexes on them, they are rebuilt on the surrogate keys below
+                ALTER TABLE flights DROP COLUMN tail_num, DROP COLUMN origin, DROP COLUMN dest;
+                -- The weekly aggregates are rebuilt from the flights below
+                DROP TABLE IF EXISTS flights_weekly;
+            END IF;
+        END $$;
+        CREATE UNIQUE INDEX IF NOT EXISTS flights_natural_key ON flights (aircraft_id, origin_id, dest_id, date);
+        CREATE INDEX IF NOT EXISTS flights_route_week ON flights (aircraft_id, origin_id, dest_id, week);
+        CREATE INDEX IF NOT EXISTS flights_origin_week ON flights (origin_id, week);
+        CREATE INDEX IF NOT EXISTS flights_date_brin ON flights USING brin (date);
+        CREATE SEQUENCE IF NOT EXISTS flights_load_version;
+        CREATE TABLE IF NOT EXISTS flights_weekly (aircraft_id INT, origin_id SMALLINT, dest_id SMALLINT, week INT, humidity_sum NUMERIC, humidity_count BIGINT,
+            load_version BIGINT, PRIMARY KEY (aircraft_id, origin_id, dest_id, week));
+        CREATE INDEX IF NOT EXISTS flights_weekly_load_version ON flights_weekly (load_version);
+        CREATE TABLE IF NOT EXISTS pipeline_runs (run_id SERIAL PRIMARY KEY, source VARCHAR(400), mode VARCHAR(20), rows BIGINT, concluded_at TIMESTAMP);
+        DO $$ BEGIN
+            IF NOT EXISTS (SELECT 1 FROM flights_weekly) THEN
+                INSERT INTO flights_weekly (aircraft_id, origin_id, dest_id, week, humidity_sum, humidity_count, load_version)
+                SELECT aircraft_id, origin_id, dest_id, week, sum(humidity), count(humidity), nextval('flights_load_version')
+                FROM flights WHERE aircraft_id IS NOT NULL AND origin_id IS NOT NULL AND dest_id IS NOT NULL AND week IS NOT NULL
+                GROUP BY aircraft_id, origin_id, dest_id, week;
+            END IF;
+        END $$;
+    """
+    # Check a connection out of the pool, it is returned to the pool on every path
+    with connPool.connection() as db_conn, db_conn.cursor() as currentVar:
+        try:
+            # Execute the SQL statement
+            currentVar.execute(postgreSQL)
+
+            # Commit the changes to the database
+            db_conn.commit()
+        except Exception as error:
+            # Rollback the changes and stop the service, the later runs need the schema
+            db_conn.rollback()
+            print(f"Schema initialization failed: {error}")
+            raise
 
 # Function to store message information in the database
 def message_info(update):
     # Get the current date and time
     now = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    # Create a database connection
-    db_conn = create_connection()
-    # Use a context manager to automatically handle the database connection and cursor
-    with db_conn, db_conn.cursor() as cursor:
+    # Check a connection out of the pool and use a context manager to automatically handle the transaction and cursor
+    with connPool.connection() as db_conn, db_conn, db_conn.cursor() as cursor:
         # Execute an SQL statement to insert the message information into the 'operations' table
         cursor.execute("INSERT INTO operations (update, loaddate) VALUES (%s, %s)", (update, now))
-    # Close the database connection
-    close_connection(db_conn)
+
+# Function to read the stored watermark of a source file
+def loadWatermark(source):
+    # Fetch the watermark of the source, if it has been loaded before, over a pooled connection
+    with connPool.connection() as db_conn, db_conn, db_conn.cursor() as cursor:
+        cursor.execute("SELECT size, mtime, head_hash, tail_hash, byte_offset, plan_id FROM source_watermark WHERE source = %s", (source,))
+        row = cursor.fetchone()
+    # Return the watermark as a dictionary
+    return dict(zip(["size", "mtime", "head_hash", "tail_hash", "byte_offset", "plan_id"], row)) if row else None
+
+# Function to check whether the plan of a source was already loaded, as when a task is retried after its load committed.
+# Every plan carries its own identifier, so a later run, such as a full refresh of an unchanged file, loads again
+def watermarkStored(stored, source):
+    return stored is not None and stored["plan_id"] == source["plan_id"]
+
+# Function to check inside the transaction that loads a source whether its plan still applies to the stored watermark,
+# locking the watermark until the load commits. A plan whose watermark is already stored was loaded by an earlier attempt,
+# and an append, which adds its sums and counts to the stored rows, only applies on top of the watermark it was planned from
+def claimWatermark(cursor, source):
+    cursor.execute("SELECT size, mtime, head_hash, tail_hash, byte_offset, plan_id FROM source_watermark WHERE source = %s FOR UPDATE", (source["source"],))
+    row = cursor.fetchone()
+    stored = dict(zip(["size", "mtime", "head_hash", "tail_hash", "byte_offset", "plan_id"], row)) if row else None
+    if watermarkStored(stored, source):
+        return False
+    return source["mode"] != "append" or (stored is not None and stored["byte_offset"] == source["start_offset"])
+
+# Function to store the watermark of a source file inside the transaction that loads its data
+def saveWatermark(cursor, source):
+    cursor.execute("""
+        INSERT INTO source_watermark (source, size, mtime, head_hash, tail_hash, byte_offset, plan_id, loaddate)
+        VALUES (%(source)s, %(size)s, %(mtime)s, %(head_hash)s, %(tail_hash)s, %(byte_offset)s, %(plan_id)s, now())
+        ON CONFLICT (source) DO UPDATE SET size = EXCLUDED.size, mtime = EXCLUDED.mtime, head_hash = EXCLUDED.head_hash,
+            tail_hash = EXCLUDED.tail_hash, byte_offset = EXCLUDED.byte_offset, plan_id = EXCLUDED.plan_id, loaddate = EXCLUDED.loaddate;
+    """, source)
+
+# Function to record the conclusion of a run inside the transaction that loads its data, notifying the listeners of the
+# 'pipeline_runs' channel once the transaction commits
+def concludeRun(cursor, source, rows):
+    cursor.execute("INSERT INTO pipeline_runs (source, mode, rows, concluded_at) VALUES (%s, %s, %s, now()) RETURNING run_id",
+                   (source["source"], source["mode"], rows))
+    run_id = cursor.fetchone()[0]
+    cursor.execute("SELECT pg_notify('pipeline_runs', %s)", (str(run_id),))
+    return run_id
+
+# Function to build the assignments applied to a 'flights' row whose natural key already exists
+def upsertAssignments(mode):
+    # Appended data adds its sums and counts to the stored ones, so a day split across runs keeps its exact mean
+    if mode == "append":
+        return ("humidity_sum = flights.humidity_sum + EXCLUDED.humidity_sum, humidity_count = flights.humidity_count + EXCLUDED.humidity_count, "
+                "humidity = round(((flights.humidity_sum + EXCLUDED.humidity_sum) / (flights.humidity_count + EXCLUDED.humidity_count))::numeric, 2)")
+    # A rewritten source replaces the stored values, so re-reading it is idempotent
+    return "week = EXCLUDED.week, humidity = EXCLUDED.humidity, humidity_sum = EXCLUDED.humidity_sum, humidity_count = EXCLUDED.humidity_count"
+
+# Function to refresh the weekly aggregates of the keys touched by a load inside the transaction of the load
+def refreshWeeklyAggregates(cursor, changed_table):
+    # Take a new load version, the cluster model uses it to find the keys changed since its last run
+    cursor.execute("SELECT nextval('flights_load_version')")
+    load_version = cursor.fetchone()[0]
+    # Recompute the humidity sum and count of every (aircraft_id, origin_id, dest_id, week) key present in the loaded rows
+    cursor.execute(f"""
+        WITH changed AS (SELECT DISTINCT aircraft_id, origin_id, dest_id, week FROM {changed_table})
+        INSERT INTO flights_weekly (aircraft_id, origin_id, dest_id, week, humidity_sum, humidity_count, load_version)
+        SELECT f.aircraft_id, f.origin_id, f.dest_id, f.week, sum(f.humidity), count(f.humidity), %s
+        FROM flights f JOIN changed c USING (aircraft_id, origin_id, dest_id, week)
+        GROUP BY f.aircraft_id, f.origin_id, f.dest_id, f.week
+        ON CONFLICT (aircraft_id, origin_id, dest_id, week) DO UPDATE SET humidity_sum = EXCLUDED.humidity_sum,
+            humidity_count = EXCLUDED.humidity_count, load_version = EXCLUDED.load_version;
+    """, (load_version,))
+    # Return the load version
+    return load_version
+
+# Function to drop the monthly partitions of 'flights' older than the retention window inside the transaction that loads
+# the data, recomputing the weekly aggregates of the keys they held
+def applyRetention(cursor):
+    months = pipelineConfiguration.retention_months
+    if not months:
+        return []
+    # List the partitions, named after their month so the names sort chronologically
+    cursor.execute("SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid WHERE i.inhparent = 'flights'::regclass ORDER BY c.relname")
+    partitions = [row[0] for row in cursor.fetchall()]
+    if not partitions:
+        return []
+    # Keep the partitions of the newest month and the months before it within the window
+    newest = int(partitions[-1][-6:-2]) * 12 + int(partitions[-1][-2:]) - 1
+    oldest_kept = newest - months + 1
+    expired = [name for name in partitions if name < f"flights_{oldest_kept // 12:04d}{oldest_kept % 12 + 1:02d}"]
+    if not expired:
+        return []
+    # Remember the keys of the expired partitions, drop the partitions and recompute the weekly aggregates of the keys
+    cursor.execute("CREATE TEMP TABLE flights_retired ON COMMIT DROP AS " +
+                   " UNION ".join(f"SELECT DISTINCT aircraft_id, origin_id, dest_id, week FROM {name}" for name in expired))
+    for name in expired:
+        cursor.execute(f"DROP TABLE {name};")
+    cursor.execute("""
+        DELETE FROM flights_weekly w USING flights_retired r
+        WHERE w.aircraft_id = r.aircraft_id AND w.origin_id = r.origin_id AND w.dest_id = r.dest_id AND w.week = r.week;
+    """)
+    refreshWeeklyAggregates(cursor, "flights_retired")
+    # Return the dropped partitions
+    return expired
+
+# Function to build an empty dataframe shaped like the ingested records
+def emptyRecords():
+    return pandas.DataFrame({col: pandas.Series(dtype=dtype[col]) for col in columns_to_read})
+
+# Function to decide whether the planned read can be served from or stored in the columnar cache
+def cacheable(source):
+    # Only a read of the whole file matches a snapshot. Incremental runs skip an unchanged file, while a full refresh plans
+    # a new load of it every run and reads the snapshot instead of the CSV
+    return (pipelineConfiguration.columnar_cache and not pipelineConfiguration.incremental_ingestion
+            and source["header_end"] == source["start_offset"] < source["byte_offset"])
+
+# Function to read the planned part of the source in chunks, through the columnar cache when possible
+def readSource(source):
+    chunksize = pipelineConfiguration.chunksize
+    if not cacheable(source):
+        return source_reader.read_chunks(source, columns_to_read, dtype, chunksize), "columnar cache bypassed"
+    # Serve the chunks from the snapshot of the source when one exists
+    snapshot = columnar_cache.lookup(source)
+    if snapshot:
+        return columnar_cache.iter_chunks(snapshot, chunksize), "columnar cache hit"
+    # Parse the CSV otherwise, storing the parsed columns as a new snapshot
+    return cachedChunks(source, chunksize), "columnar cache miss"
+
+# Function to parse the source in chunks while writing them to a columnar cache snapshot
+def cachedChunks(source, chunksize):
+    writer = columnar_cache.SnapshotWriter(source)
+    try:
+        for chunk in source_reader.read_chunks(source, columns_to_read, dtype, chunksize):
+            writer.append(chunk)
+            yield chunk
+    except BaseException:
+        # Discard the partial snapshot when parsing fails or stops early
+        writer.abort()
+        raise
+    # Publish the snapshot and evict the oldest ones
+    writer.commit()
+    columnar_cache.evict(source, pipelineConfiguration.cache_snapshots_kept)
 
 @prefect.task(max_retries=4, retry_delay=datetime.timedelta(seconds=1))
-def dataIngestion():
+@stageMetrics.timed("data-pipeline")
+def sourceWatermark():
+    # Compare the source file with its stored watermark and plan which part of it has to be read,
+    # a full refresh plans a read of the whole source
+    previous = loadWatermark(filename) if pipelineConfiguration.incremental_ingestion else None
+    return source_reader.scan_source(filename, previous)
+
+@prefect.task(max_retries=4, retry_delay=datetime.timedelta(seconds=1))
+@stageMetrics.timed("data-pipeline")
+def dataIngestion(source):
     # Log message indicating the initiation of the ingestion process
     message_info("Ingestion Process Initiated")
 
-    # Define the specific columns to read only from the CSV file
-    columns_to_read = ["TAIL_NUM", "ORIGIN", "DEST", "MONTH", "DAY_OF_MONTH", "YEAR", "RelativeHumidityOrigin"]
-
-    # Define the data types for the columns
-    dtype = {
-        col: "string" if col in ["TAIL_NUM", "ORIGIN", "DEST"] else
-        int if col in ["MONTH", "DAY_OF_MONTH", "YEAR"] else float for col in columns_to_read
-    }
-
-    # Define the chunk size and the filename
-    chunksize = 10000
-    filename = "datapipeline/flight_weather.csv"
+    # Define the chunk size
+    chunksize = pipelineConfiguration.chunksize
 
     # Initialize an empty list to store data chunks
     data_chunks = []
 
-    # Read the CSV file in chunks
-    reader = pandas.read_csv(filename, usecols=columns_to_read, dtype=dtype, chunksize=chunksize)
+    # Read the new part of the CSV file in chunks
+    reader, cache_status = readSource(source)
+
+    # Log message indicating ongoing data ingestion
+    message_info(f"Data Ingestion Ongoing ({source['mode']} read from byte {source['start_offset']})")
 
     # Iterate over the chunks
-    for i, chunk in enumerate(reader):
+    for chunk in reader:
         # Append each chunk to the list
         data_chunks.append(chunk)
-        
-        # Log message indicating ongoing data ingestion, only for the first chunk
-        if i == 0:
-            message_info("Data Ingestion Ongoing")
 
-    # Concatenate all the data chunks into a single dataframe
-    result = pandas.concat(data_chunks, ignore_index=True)
+    # Concatenate all the data chunks into a single dataframe, keeping the codes dictionary-encoded
+    result = transform_engine.concat_records(data_chunks) if data_chunks else emptyRecords()
 
     # Log message indicating the conclusion of the data ingestion process
-    message_info("Data Ingestion Concluded")
+    message_info(f"Data Ingestion Concluded ({cache_status})")
 
     # Return the result
     return result
 
 @prefect.task(max_retries=4, retry_delay=datetime.timedelta(seconds=1))
-def data_processing(records):
-    # Log message indicating the initiation of data processing
-    message_info("Data Processing Initiated")
-
-    # Drop records with 'NaN' values in the 'RelativeHumidityOrigin' column
-    records = records.drop(records[records.RelativeHumidityOrigin == 'NaN'].index)
-
-    # Define the columns to group by
-    group_cols = ['TAIL_NUM', 'ORIGIN', 'DEST', 'YEAR', 'MONTH', 'DAY_OF_MONTH']
+@stageMetrics.timed("data-pipeline")
+def parallelIngestion(source):
+    # Log message indicating the initiation of the ingestion process
+    message_info("Ingestion Process Initiated")
 
-    # Group records by the defined columns and calculate the mean of 'RelativeHumidityOrigin'
-    records = records.groupby(group_cols, as_index=False)['RelativeHumidityOrigin'].mean()
+    # Define the number of worker processes, defaulting to the CPUs available
+    workers = pipelineConfiguration.parallel_workers or workerPool.available_cpus()
 
-    # Round the 'RelativeHumidityOrigin' values to 2 decimal places
-    records['RelativeHumidityOrigin'] = records['RelativeHumidityOrigin'].round(2)
+    # Log message indicating ongoing data ingestion
+    message_info(f"Data Ingestion Ongoing ({source['mode']} read from byte {source['start_offset']} on {workers} workers)")
 
-    # Define a function to determine the week based on the 'DAY_OF_MONTH' value
-    def determineWeek(day_of_month):
-        quarters = [1, 2, 3, 4]
-        thresholds = [7, 15, 22, 31]
-        return next((q for q, t in zip(quarters, thresholds) if day_of_month <= t), 4)
+    # Reduce the snapshot of the source in process when it is cached, it needs no parsing
+    snapshot = columnar_cache.lookup(source) if cacheable(source) else None
+    if snapshot:
+        partials = [transform_engine.partial_aggregate(chunk) for chunk in columnar_cache.iter_chunks(snapshot, pipelineConfiguration.chunksize * pipelineConfiguration.spill_interval_chunks)]
+        result, cache_status = transform_engine.merge_partials(partials) if partials else None, "columnar cache hit"
+    else:
+        # Parse line-aligned byte ranges of the CSV file in worker processes, each reducing its range to partial aggregates
+        result = parallel_ingestion.parallel_aggregate(source, columns_to_read, dtype, pipelineConfiguration.chunksize, workers, cache=cacheable(source))
+        cache_status = "columnar cache miss" if cacheable(source) else "columnar cache bypassed"
+        if cacheable(source):
+            columnar_cache.evict(source, pipelineConfiguration.cache_snapshots_kept)
 
-    # Apply the 'determineWeek' function to calculate the 'Week' column
-    records['Week'] = records['DAY_OF_MONTH'].apply(determineWeek)
+    # Log message indicating the conclusion of the data ingestion process
+    message_info(f"Data Ingestion Concluded ({cache_status})")
 
-    # Convert the 'YEAR', 'MONTH', and 'DAY_OF_MONTH' columns to a single 'Date' column of type datetime
-    records['Date'] = pandas.to_datetime(records[['YEAR', 'MONTH', 'DAY_OF_MONTH']].astype(str).apply(lambda x: '-'.join(x), axis=1))
+    # Return the merged partial aggregates
+    return result if result is not None else emptyRecords()
 
-    # Drop the 'YEAR', 'MONTH', and 'DAY_OF_MONTH' columns
-    records = records.drop(columns=['YEAR', 'MONTH', 'DAY_OF_MONTH'])
+@prefect.task(max_retries=4, retry_delay=datetime.timedelta(seconds=1))
+@stageMetrics.timed("data-pipeline")
+def data_processing(records):
+    # Log message indicating the initiation of data processing
+    message_info("Data Processing Initiated")
 
-    # Sort the records by the 'Date' column
-    records = records.sort_values(by='Date')
+    # Drop the records without humidity, reduce them to the sum and count of humidity per key, then calculate the
+    # rounded mean, the 'Week' and 'Date' columns and sort by date with the columnar transform engine
+    records = transform_engine.process_records(records)
 
     # Log message indicating the conclusion of data processing
     message_info("Data Processing Concluded")
@@ -134,52 +358,231 @@ def data_processing(records):
     # Return the processed records
     return records
 
+# Function to upsert processed records into the 'flights' table on the natural key and refresh the weekly aggregates of
+# the loaded keys inside the caller's transaction
+def upsertRecords(db_obj, records, mode):
+    if records.empty:
+        return 0
+    # Create the monthly partitions the records fall into
+    db_obj.execute("SELECT flights_ensure_partitions(%s, %s)", (records['Date'].min().date(), records['Date'].max().date()))
+    # Replace the codes of the aircraft and airports with their surrogate keys
+    records = dimensions.encode(db_obj, records)
+    rows = bulkLoader.upsert_dataframe(
+        db_obj,
+        "flights",
+        records[['aircraft_id', 'origin_id', 'dest_id', 'RelativeHumidityOrigin', 'humidity_sum', 'humidity_count', 'Week', 'Date']],
+        ["aircraft_id", "origin_id", "dest_id", "humidity", "humidity_sum", "humidity_count", "week", "date"],
+        natural_key,
+        upsertAssignments(mode),
+    )
+    refreshWeeklyAggregates(db_obj, "flights_upsert")
+    # Return the number of inserted or updated rows
+    return rows
+
 @prefect.task(max_retries=4, retry_delay=datetime.timedelta(seconds=1))
-def data_integration(records):
+@stageMetrics.timed("data-pipeline")
+def data_integration(records, source):
     # Log message indicating the start of data integration
     message_info("Data Integration Started")
 
-    # Create a database connection
-    db_conn = create_connection()
-    db_obj = db_conn.cursor()
-
-    # Initialize variables for batch processing
-    rows = []
-    batch_size = 1500
-    total_rows = 0
-
-    # Iterate over the records
-    for i, tuple in records.iterrows():
-        if not pandas.isnull(tuple[3]):
-            # Append the non-null tuple values to the 'rows' list
-            rows.append((tuple[0], tuple[1], tuple[2], tuple[3], tuple[4], tuple[5]))
-
-        # Process the batch when it reaches the specified batch size
-        if len(rows) >= batch_size:
-            db.execute_values(
-                db_obj,
-                "INSERT INTO flights (tail_num, origin, dest, humidity, week, date) VALUES %s;",
-                rows,
-            )
-            db_conn.commit()
-            total_rows += len(rows)
-            rows.clear()
-
-    # Process the remaining rows if there are any
-    if rows:
-        db.execute_values(
-            db_obj,
-            "INSERT INTO flights (tail_num, origin, dest, humidity, week, date) VALUES %s;",
-            rows,
-        )
-        db_conn.commit()
-        total_rows += len(rows)
-
-    # Close the database connection
-    close_connection(db_conn)
+    # Drop the records without a humidity value
+    records = records.dropna(subset=['RelativeHumidityOrigin'])
+
+    # Record the start time of the load
+    start = time.perf_counter()
+
+    # Upsert the records into the 'flights' table on the natural key, refresh the weekly aggregates of the loaded keys,
+    # store the watermark and record the run in a single transaction, unless a retried attempt already committed them
+    with connPool.connection() as db_conn, db_conn, db_conn.cursor() as db_obj:
+        loaded = claimWatermark(db_obj, source)
+        rows, retired = 0, []
+        if loaded:
+            rows = upsertRecords(db_obj, records, source["mode"])
+            retired = applyRetention(db_obj)
+            saveWatermark(db_obj, source)
+            concludeRun(db_obj, source, rows)
+    report = bulkLoader.LoadReport("flights", rows, time.perf_counter() - start)
+    stageMetrics.current().rows_out = report.rows
 
     # Log message indicating the conclusion of data integration
-    message_info(f"Data Integration of {total_rows} rows concluded")
+    message_info(f"Data Integration of {report.rows} rows concluded ({report.rows_per_second:.0f} rows/s)" if loaded else
+                 "Data Integration skipped, an earlier attempt already loaded the planned read")
+    if retired:
+        message_info(f"Retention dropped the partitions {', '.join(retired)}")
+
+    # Return a completion message
+    return "Data Pipeline Activities Concluded"
+
+@prefect.task(max_retries=4, retry_delay=datetime.timedelta(seconds=1))
+@stageMetrics.timed("data-pipeline")
+def sourceFiles():
+    # List the source files and compare each of them with its stored watermark, planning which part of it has to be read
+    paths = source_reader.list_sources(pipelineConfiguration.source_pattern)
+    return [source_reader.scan_source(path, loadWatermark(path) if pipelineConfiguration.incremental_ingestion else None) for path in paths]
+
+@prefect.task(max_retries=4, retry_delay=datetime.timedelta(seconds=1))
+@stageMetrics.timed("data-pipeline")
+def fileIngestion(plans):
+    # Log message indicating the initiation of the ingestion process
+    message_info("Ingestion Process Initiated")
+
+    # Keep the files with something to read, and define the number of files read at a time
+    pending = [plan for plan in plans if plan["start_offset"] < plan["byte_offset"]]
+    workers = max(min(pipelineConfiguration.source_workers or workerPool.available_cpus(), len(pending)), 1)
+
+    # Log message indicating ongoing data ingestion
+    message_info(f"Data Ingestion Ongoing ({len(pending)} of {len(plans)} files to read, {workers} at a time)")
+
+    # Record the start time of the load
+    start = time.perf_counter()
+    total_rows, loaded_files = 0, 0
+
+    # Read, decompress and reduce the files in worker processes, loading every file as soon as it is reduced while the
+    # next files are being read
+    for i, (plan, partial) in enumerate(parallel_ingestion.aggregate_files(pending, columns_to_read, dtype, pipelineConfiguration.chunksize, workers), 1):
+        # Upsert the records of the file and store its watermark in one transaction, so a failed run resumes at the
+        # first file not loaded, and a retry of this task skips the files an earlier attempt loaded
+        with connPool.connection() as db_conn, db_conn, db_conn.cursor() as db_obj:
+            loaded = claimWatermark(db_obj, plan)
+            rows = upsertRecords(db_obj, transform_engine.process_records(partial), plan["mode"]) if loaded and partial is not None else 0
+            if loaded:
+                saveWatermark(db_obj, plan)
+        total_rows += rows
+        loaded_files += loaded
+        # Log message recording the progress of the file
+        message_info(f"File {i} of {len(pending)} {'loaded' if loaded else 'already loaded'} ({plan['source']}, {plan['mode']}, {rows} rows)")
+
+    # Apply the retention and record the run once every file is loaded, when at least one of them was loaded by this attempt
+    retired = []
+    if loaded_files:
+        with connPool.connection() as db_conn, db_conn, db_conn.cursor() as db_obj:
+            retired = applyRetention(db_obj)
+            concludeRun(db_obj, {"source": pipelineConfiguration.source_pattern, "mode": "files"}, total_rows)
+    stageMetrics.current().rows_out = total_rows
+
+    # Log message indicating the conclusion of data ingestion and integration
+    message_info(f"Data Integration of {total_rows} rows from {loaded_files} files concluded ({total_rows / (time.perf_counter() - start):.0f} rows/s)"
+                 if loaded_files else "Data Integration skipped, no file had to be loaded")
+    if retired:
+        message_info(f"Retention dropped the partitions {', '.join(retired)}")
+
+    # Return a completion message
+    return "Data Pipeline Activities Concluded"
+
+# Function to spill partial aggregates into the 'flights_partial' staging table
+def spillPartials(db_conn, partial):
+    # Calculate the 'Week' and 'Date' columns of the partial aggregate
+    partial = transform_engine.add_calendar_columns(partial)
+    # Replace the codes of the aircraft and airports with their surrogate keys, new codes are committed with the keys
+    with db_conn, db_conn.cursor() as cursor:
+        partial = dimensions.encode(cursor, partial)
+    # Stream the partial aggregates into the staging table with COPY and return the number of spilled rows
+    return bulkLoader.load_dataframe(
+        db_conn,
+        "flights_partial",
+        partial[['aircraft_id', 'origin_id', 'dest_id', 'Week', 'Date', 'humidity_sum', 'humidity_count']],
+        ["aircraft_id", "origin_id", "dest_id", "week", "date", "humidity_sum", "humidity_count"],
+    ).rows
+
+@prefect.task(max_retries=4, retry_delay=datetime.timedelta(seconds=1))
+@stageMetrics.timed("data-pipeline")
+def streamingPipeline(source):
+    # Log message indicating the initiation of the ingestion process
+    message_info("Ingestion Process Initiated")
+
+    # Skip a plan an earlier attempt of this task already loaded
+    if watermarkStored(loadWatermark(source["source"]), source):
+        message_info("Data Integration skipped, an earlier attempt already loaded the planned read")
+        return "Data Pipeline Activities Concluded"
+
+    # Check a connection out of the pool for the whole run
+    with connPool.connection() as db_conn:
+        # Clear partial aggregates left over by an earlier attempt
+        with db_conn, db_conn.cursor() as db_obj:
+            db_obj.execute("TRUNCATE flights_partial;")
+
+        # Define the memory budget and the partial aggregate share of it in bytes, the budget bounds the growth of the
+        # resident memory over its level at the start of the read
+        budget_mb = pipelineConfiguration.memory_budget_mb
+        partial_budget = budget_mb * 1048576 // 2
+        baseline_mb = stageMetrics.rss_mb()
+
+        # Initialize the pending partial aggregates and their memory footprint
+        partials = []
+        partial_bytes = 0
+        integration_started = False
+
+        # Read the new part of the CSV file in chunks
+        reader, cache_status = readSource(source)
+
+        # Log messages indicating ongoing ingestion and processing
+        message_info(f"Data Ingestion Ongoing ({source['mode']} read from byte {source['start_offset']})")
+        message_info("Data Processing Initiated")
+
+        # Iterate over the chunks, reducing each one to partial aggregates as soon as it is read
+        for i, chunk in enumerate(reader):
+
+            # Reduce the chunk and keep track of the memory held by pending partial aggregates
+            partial = transform_engine.partial_aggregate(chunk)
+            partials.append(partial)
+            partial_bytes += partial.memory_usage(deep=True).sum()
+
+            # Spill the pending partial aggregates once they or the memory grown since the start of the read outgrow the
+            # budget, or the spill interval is reached
+            grown_mb = stageMetrics.rss_mb() - baseline_mb if baseline_mb is not None else 0
+            if partial_bytes >= partial_budget or grown_mb >= budget_mb or (i + 1) % pipelineConfiguration.spill_interval_chunks == 0:
+                # Log message indicating the start of data integration, only for the first spill
+                if not integration_started:
+                    message_info("Data Integration Started")
+                    integration_started = True
+                spillPartials(db_conn, transform_engine.merge_partials(partials))
+                partials.clear()
+                partial_bytes = 0
+
+        # Log messages indicating the conclusion of the ingestion and processing of the chunks
+        message_info(f"Data Ingestion Concluded ({cache_status})")
+        message_info("Data Processing Concluded")
+
+        # Spill the remaining partial aggregates
+        if not integration_started:
+            message_info("Data Integration Started")
+        if partials:
+            spillPartials(db_conn, transform_engine.merge_partials(partials))
+
+        # Record the start time of the final merge
+        start = time.perf_counter()
+
+        # Upsert the partial aggregates into the 'flights' table, refresh the weekly aggregates of the loaded keys, store the
+        # watermark, record the run and clear the staging table in one transaction, unless the plan no longer applies to
+        # the stored watermark. Streaming only bounds the memory of the read, 'flights' is written once the whole planned
+        # read is staged. The spills are not upserted into 'flights' one by one: a replace would overwrite the day
+        # split across two spills with its second part, and a retried append would add the committed spills again, as the
+        # watermark only advances with the whole planned read
+        with db_conn, db_conn.cursor() as db_obj:
+            total_rows, retired = 0, []
+            if claimWatermark(db_obj, source):
+                # Create the monthly partitions the partial aggregates fall into
+                db_obj.execute("SELECT flights_ensure_partitions(min(date), max(date)) FROM flights_partial;")
+                db_obj.execute(f"""
+                    INSERT INTO flights (aircraft_id, origin_id, dest_id, week, date, humidity, humidity_sum, humidity_count)
+                    SELECT aircraft_id, origin_id, dest_id, week, date, round((sum(humidity_sum) / sum(humidity_count))::numeric, 2), sum(humidity_sum), sum(humidity_count)
+                    FROM flights_partial
+                    GROUP BY aircraft_id, origin_id, dest_id, week, date
+                    ON CONFLICT ({', '.join(natural_key)}) DO UPDATE SET {upsertAssignments(source["mode"])};
+                """)
+                total_rows = db_obj.rowcount
+                if total_rows:
+                    refreshWeeklyAggregates(db_obj, "flights_partial")
+                retired = applyRetention(db_obj)
+                saveWatermark(db_obj, source)
+                concludeRun(db_obj, source, total_rows)
+            stageMetrics.current().rows_out = total_rows
+            db_obj.execute("TRUNCATE flights_partial;")
+
+    # Log message indicating the conclusion of data integration
+    message_info(f"Data Integration of {total_rows} rows concluded ({total_rows / (time.perf_counter() - start):.0f} rows/s)")
+    if retired:
+        message_info(f"Retention dropped the partitions {', '.join(retired)}")
 
     # Return a completion message
     return "Data Pipeline Activities Concluded"
@@ -200,14 +603,25 @@ def main():
 
     # Create a Prefect flow named "Data Pipeline" with the defined schedule
     with prefect.Flow("Data Pipeline", schedule=varA) as flow:
-        # Ingest data using the dataIngestion task
-        records = dataIngestion()
-
-        # Perform data processing using the data_processing task
-        records = data_processing(records)
-
-        # Integrate data into the database using the data_integration task
-        data_integration(records)
+        if pipelineConfiguration.source_pattern:
+            # Plan the files of the source set and load them file by file using the sourceFiles and fileIngestion tasks
+            fileIngestion(sourceFiles())
+        else:
+            # Plan which part of the source is new using the sourceWatermark task
+            source = sourceWatermark()
+
+            if pipelineConfiguration.ingestion_mode == 'streaming':
+                # Ingest, process and integrate the data chunk by chunk using the streamingPipeline task
+                streamingPipeline(source)
+            else:
+                # Ingest data using the parallelIngestion or dataIngestion task
+                records = parallelIngestion(source) if pipelineConfiguration.ingestion_mode == 'parallel' else dataIngestion(source)
+
+                # Perform data processing using the data_processing task
+                records = data_processing(records)
+
+                # Integrate data into the database using the data_integration task
+                data_integration(records, source)
 
     # Initialize the database schema using the initializeSchema function
     initializeSchema()
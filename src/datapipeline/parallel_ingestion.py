@@ -0,0 +1,95 @@
+'''
+The parallel ingestion splits the planned byte range of the CSV source into ranges aligned to line boundaries and
+parses them in a process pool. Every worker reduces its range to partial aggregates (sum and count of humidity per
+key) with the transform engine, and the partial aggregates of all workers are merged at the end. The source must not
+hold quoted fields with embedded newlines, which is the case for the flight weather CSV. When the whole file is read,
+every worker also writes the parsed columns of its range as segments of one columnar cache snapshot. A compressed
+source cannot be split, it is reduced as a single range.
+
+A set of source files is reduced file by file in the same pool, a bounded number of files at a time, and the partial
+aggregates of every file are handed back in the order of the files as soon as they are ready, so the caller loads and
+records them one file at a time while the next files are being read.
+
+'''
+# Importation of libraries
+import collections, multiprocessing
+from concurrent import futures
+import workerPool, source_reader, transform_engine, columnar_cache
+
+# Smallest byte range handed to a worker
+min_range_bytes = 1 << 22
+
+# Number of ranges per worker, so that workers finishing early pick up more work
+ranges_per_worker = 2
+
+# Function to split a byte range of a file into ranges that start and end on line boundaries
+def split_ranges(path, start, end, parts):
+    # Define the number of ranges, keeping every range above the minimum size
+    parts = max(1, min(parts, (end - start) // min_range_bytes))
+    boundaries = [start]
+    with open(path, "rb") as handle:
+        for i in range(1, parts):
+            # Move each cut forward to the start of the next line
+            handle.seek(start + (end - start) * i // parts)
+            handle.readline()
+            boundaries.append(min(max(handle.tell(), boundaries[-1]), end))
+    boundaries.append(end)
+    # Return the non-empty ranges
+    return [(s, e) for s, e in zip(boundaries, boundaries[1:]) if e > s]
+
+# Function run by a worker to reduce a byte range to partial aggregates
+def aggregate_range(plan, start, end, usecols, dtype, chunksize, cache_prefix=None):
+    # Write the parsed columns of the range into the shared snapshot when caching
+    writer = columnar_cache.SnapshotWriter(plan, prefix=cache_prefix, reset=False) if cache_prefix else None
+    partials = []
+    # Parse the range in chunks and reduce every chunk as soon as it is read
+    for chunk in source_reader.read_chunks(plan, usecols, dtype, chunksize, start, end):
+        if writer:
+            writer.append(chunk)
+        partials.append(transform_engine.partial_aggregate(chunk))
+    # Return the partial aggregates of the whole range with the cache segments written for it
+    return (transform_engine.merge_partials(partials) if partials else None), (writer.flush() if writer else []), (writer.kinds if writer else {})
+
+# Function to reduce the planned byte range of the source to partial aggregates with a pool of worker processes
+def parallel_aggregate(plan, usecols, dtype, chunksize, workers=None, cache=False):
+    # Default to the CPUs available to the process
+    workers = workers or workerPool.available_cpus()
+    ranges = [(plan["start_offset"], plan["byte_offset"])] if plan.get("compression") else \
+        split_ranges(plan["source"], plan["start_offset"], plan["byte_offset"], workers * ranges_per_worker)
+    # Prepare the snapshot the workers write their segments into
+    writer = columnar_cache.SnapshotWriter(plan) if cache else None
+    try:
+        # Parse the ranges in worker processes started with 'spawn', as the flow runs inside a threaded executor
+        with futures.ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+            jobs = [pool.submit(aggregate_range, plan, start, end, usecols, dtype, chunksize, f"range-{i:05d}" if cache else None)
+                    for i, (start, end) in enumerate(ranges)]
+            results = [job.result() for job in jobs]
+    except BaseException:
+        if writer:
+            writer.abort()
+        raise
+    # Publish the snapshot made of the segments of all the ranges
+    if writer:
+        writer.commit([segment for _, segments, _ in results for segment in segments], next((kinds for _, _, kinds in results if kinds), {}))
+    # Merge the partial aggregates of all the ranges
+    partials = [partial for partial, _, _ in results if partial is not None]
+    return transform_engine.merge_partials(partials) if partials else None
+
+# Function to reduce every planned source file to partial aggregates with a pool of worker processes, yielding the plan
+# and the partial aggregates of every file in the order of the plans, with no more than 'workers' files in flight
+def aggregate_files(plans, usecols, dtype, chunksize, workers=None):
+    workers = workers or workerPool.available_cpus()
+    pending = collections.deque()
+    plans = iter(plans)
+    with futures.ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+        while True:
+            # Keep the pool busy without reading ahead of the files already handed back
+            while len(pending) < workers:
+                plan = next(plans, None)
+                if plan is None:
+                    break
+                pending.append((plan, pool.submit(aggregate_range, plan, plan["start_offset"], plan["byte_offset"], usecols, dtype, chunksize)))
+            if not pending:
+                return
+            plan, job = pending.popleft()
+            yield plan, job.result()[0]
@@ -0,0 +1,168 @@
+'''
+The source reader fingerprints the CSV source of the data pipeline and decides which part of it still has to be
+processed. The watermark of the previous run (file size, modification time, a hash of the head of the file, a hash
+of the bytes before the consumed offset and the consumed byte offset) is compared with the file on disk:
+
+- unchanged: the file has the same size, modification time and head, nothing has to be read.
+- append: the file grew and the bytes up to the consumed offset are untouched, only the new lines are read.
+- replace: the file was rewritten, the whole file is read again and replaces the stored values.
+
+Gzip (.gz) and zstd (.zst) compressed sources have no byte offsets into their rows, so they are either unchanged or
+read again in full, decompressed as a stream chunk by chunk. A source may also be a set of files, listed by a glob, a
+directory or a manifest file holding one path per line.
+
+'''
+# Importation of libraries
+import io, os, csv, glob, uuid, hashlib, pandas
+
+# Number of bytes hashed at the head of the file and before the consumed offset
+window_size = 1 << 16
+
+# Compressions of the sources by file extension, read through pandas ('zstd' needs the zstandard package)
+compressions = {".gz": "gzip", ".zst": "zstd"}
+
+# Extensions of the source files picked from a directory
+source_extensions = (".csv", ".csv.gz", ".csv.zst")
+
+# Function to get the compression of a source file from its extension, None for an uncompressed file
+def compression_of(path):
+    return compressions.get(os.path.splitext(path)[1].lower())
+
+# Function to list the source files of a glob, a directory or a manifest file holding one path per line (relative to
+# the manifest, blank lines and lines starting with '#' ignored), in a stable order
+def list_sources(pattern):
+    if os.path.isdir(pattern):
+        return sorted(os.path.join(pattern, name) for name in os.listdir(pattern) if name.lower().endswith(source_extensions))
+    if os.path.isfile(pattern) and not pattern.lower().endswith(source_extensions):
+        with open(pattern) as manifest:
+            lines = [line.strip() for line in manifest]
+        return [os.path.join(os.path.dirname(pattern), line) for line in lines if line and not line.startswith("#")]
+    return sorted(glob.glob(pattern))
+
+# Function to hash a byte range of a file
+def hash_range(handle, start, end):
+    # Read the bytes of the range and return their SHA-256 digest
+    handle.seek(start)
+    return hashlib.sha256(handle.read(max(end - start, 0))).hexdigest()
+
+# Function to find the offset just past the last complete line of a file
+def last_line_end(handle, size):
+    # Search backwards window by window for the last newline character
+    end = size
+    while end > 0:
+        start = max(end - window_size, 0)
+        handle.seek(start)
+        position = handle.read(end - start).rfind(b"\n")
+        if position != -1:
+            return start + position + 1
+        end = start
+    # Return zero when the file holds no complete line
+    return 0
+
+# Function to compare a source file with its previous watermark and plan the next read
+def scan_source(path, previous=None):
+    # Get the size and the modification time of the file
+    stat = os.stat(path)
+    if compression_of(path):
+        return scan_compressed(path, stat, previous)
+    with open(path, "rb") as handle:
+        # Read the header line
+        header_line = handle.readline()
+        header_end = handle.tell()
+        # Find the end of the last complete line, the trailing partial line is left for the next run
+        byte_offset = max(last_line_end(handle, stat.st_size), header_end)
+        # Hash the head of the consumed part of the file and the bytes right before the consumed offset
+        head_hash = hash_range(handle, 0, min(byte_offset, window_size))
+        tail_hash = hash_range(handle, max(byte_offset - window_size, 0), byte_offset)
+
+        # Decide which part of the file has to be read
+        if previous and previous["size"] == stat.st_size and previous["mtime"] == stat.st_mtime and previous["head_hash"] == head_hash:
+            mode, start_offset = "unchanged", byte_offset
+        elif (previous and header_end <= previous["byte_offset"] <= byte_offset
+              and hash_range(handle, 0, min(previous["byte_offset"], window_size)) == previous["head_hash"]
+              and hash_range(handle, max(previous["byte_offset"] - window_size, 0), previous["byte_offset"]) == previous["tail_hash"]):
+            mode, start_offset = "append", previous["byte_offset"]
+        else:
+            mode, start_offset = "replace", header_end
+
+    # Return the plan together with the watermark to store once the data is loaded, and an identifier shared by every
+    # attempt to load it
+    return {
+        "plan_id": uuid.uuid4().hex,
+        "source": path,
+        "size": stat.st_size,
+        "mtime": stat.st_mtime,
+        "head_hash": head_hash,
+        "tail_hash": tail_hash,
+        "byte_offset": byte_offset,
+        "header_end": header_end,
+        "start_offset": start_offset,
+        "mode": mode,
+        "header": next(csv.reader([header_line.decode("utf-8-sig").strip()])),
+        "compression": None,
+    }
+
+# Function to plan the read of a compressed source file, which is either unchanged or read again in full
+def scan_compressed(path, stat, previous=None):
+    with open(path, "rb") as handle:
+        # Fingerprint the compressed bytes of the file
+        head_hash = hash_range(handle, 0, min(stat.st_size, window_size))
+        tail_hash = hash_range(handle, max(stat.st_size - window_size, 0), stat.st_size)
+    unchanged = previous and previous["size"] == stat.st_size and previous["mtime"] == stat.st_mtime and previous["head_hash"] == head_hash
+    # The offsets count compressed bytes: a planned read covers the whole file, an unchanged file plans an empty read
+    return {
+        "plan_id": uuid.uuid4().hex,
+        "source": path,
+        "size": stat.st_size,
+        "mtime": stat.st_mtime,
+        "head_hash": head_hash,
+        "tail_hash": tail_hash,
+        "byte_offset": stat.st_size,
+        "header_end": 0,
+        "start_offset": stat.st_size if unchanged else 0,
+        "mode": "unchanged" if unchanged else "replace",
+        "header": list(pandas.read_csv(path, compression=compression_of(path), nrows=0).columns),
+        "compression": compression_of(path),
+    }
+
+# Raw stream over a byte range of a file
+class ByteRangeReader(io.RawIOBase):
+    def __init__(self, path, start, end):
+        self._handle = open(path, "rb")
+        self._handle.seek(start)
+        self._remaining = max(end - start, 0)
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        # Read no further than the end of the range
+        size = min(len(buffer), self._remaining)
+        if size == 0:
+            return 0
+        count = self._handle.readinto(memoryview(buffer)[:size])
+        self._remaining -= count
+        return count
+
+    def close(self):
+        self._handle.close()
+        super().close()
+
+# Function to open a byte range of a file as a buffered binary stream
+def open_byte_range(path, start, end):
+    return io.BufferedReader(ByteRangeReader(path, start, end), buffer_size=1 << 20)
+
+# Function to read the planned byte range of the source in chunks
+def read_chunks(plan, usecols, dtype, chunksize, start=None, end=None):
+    # Default to the range planned by 'scan_source'
+    start = plan["start_offset"] if start is None else start
+    end = plan["byte_offset"] if end is None else end
+    # Return no chunks when there is nothing to read
+    if start >= end:
+        return iter(())
+    # Decompress a compressed source as a stream, it is always read in full
+    if plan.get("compression"):
+        return pandas.read_csv(plan["source"], compression=plan["compression"], usecols=usecols, dtype=dtype, chunksize=chunksize)
+    # Parse the range with the header of the file, since the range itself does not start with it
+    return pandas.read_csv(open_byte_range(plan["source"], start, end), names=plan["header"], header=None,
+                           usecols=usecols, dtype=dtype, chunksize=chunksize)
@@ -0,0 +1,76 @@
+'''
+The transform engine holds the columnar transformations of the data pipeline. Every step works on whole columns:
+missing humidity readings are filtered with a real null check, the humidity readings are reduced to mergeable
+partial aggregates (sum and count per key), and the week of the month and the date are derived from the integer
+day, month and year columns without any per-row Python code. The tail number and airport codes are kept dictionary-
+encoded as categoricals, so the group-by works on their integer codes instead of hashing strings.
+
+'''
+# Importation of libraries
+import numpy, pandas
+
+# Define the columns the humidity readings are grouped by
+group_cols = ['TAIL_NUM', 'ORIGIN', 'DEST', 'YEAR', 'MONTH', 'DAY_OF_MONTH']
+
+# Define the code columns, dictionary-encoded as categoricals
+code_cols = ['TAIL_NUM', 'ORIGIN', 'DEST']
+
+# Define the last day of the first three weeks of a month, every later day belongs to the fourth week
+week_thresholds = numpy.array([7, 15, 22])
+
+# Function to determine the week of the month of every day in a column
+def week_of_month(day_of_month):
+    # Count the thresholds strictly below each day, days up to 7 are in week 1, up to 15 in week 2 and so on
+    return numpy.searchsorted(week_thresholds, numpy.asarray(day_of_month), side='left') + 1
+
+# Function to assemble a date column from the integer year, month and day columns
+def assemble_date(year, month, day):
+    # Build the dates in one vectorized conversion, invalid dates raise just like parsing them as text
+    return pandas.to_datetime(pandas.DataFrame({'year': numpy.asarray(year), 'month': numpy.asarray(month), 'day': numpy.asarray(day)}))
+
+# Function to drop the records without a humidity reading
+def drop_missing(records):
+    return records.dropna(subset=['RelativeHumidityOrigin'])
+
+# Function to convert the code columns to categoricals with string categories, a no-op for the columns read as
+# categoricals already. A column without any code has categories of no inferred type, which could not be unified with
+# the string categories of other chunks
+def encode_codes(records):
+    records = records.astype({col: 'category' for col in code_cols})
+    return records.assign(**{col: records[col].cat.rename_categories(records[col].cat.categories.astype(str)) for col in code_cols})
+
+# Function to concatenate dataframes, first giving their code columns the union of their categories so the result
+# stays dictionary-encoded instead of falling back to strings
+def concat_records(frames):
+    frames = [encode_codes(frame) for frame in frames]
+    categories = {col: pandas.api.types.union_categoricals([frame[col] for frame in frames]).categories for col in code_cols}
+    return pandas.concat([frame.astype({col: pandas.CategoricalDtype(categories[col]) for col in code_cols}) for frame in frames], ignore_index=True)
+
+# Function to reduce records to mergeable partial aggregates (sum and count of humidity per key)
+def partial_aggregate(records):
+    # Group the records with a humidity reading by the key columns and keep the sum and count of the humidity per key
+    return encode_codes(drop_missing(records)).groupby(group_cols, observed=True)['RelativeHumidityOrigin'].agg(humidity_sum='sum', humidity_count='count').reset_index()
+
+# Function to merge several partial aggregates into one partial aggregate
+def merge_partials(partials):
+    # Concatenate the partial aggregates and add up the sums and counts of matching keys
+    return concat_records(partials).groupby(group_cols, as_index=False, observed=True)[['humidity_sum', 'humidity_count']].sum()
+
+# Function to add the 'Week' and 'Date' columns derived from the 'YEAR', 'MONTH' and 'DAY_OF_MONTH' columns
+def add_calendar_columns(records):
+    records['Week'] = week_of_month(records['DAY_OF_MONTH'])
+    records['Date'] = assemble_date(records['YEAR'], records['MONTH'], records['DAY_OF_MONTH']).to_numpy()
+    return records
+
+# Function to turn partial aggregates into processed records
+def finalize(partial):
+    # Calculate the mean humidity of every key rounded to 2 decimal places
+    partial['RelativeHumidityOrigin'] = (partial['humidity_sum'] / partial['humidity_count']).round(2)
+    # Calculate the 'Week' and 'Date' columns and drop the 'YEAR', 'MONTH', and 'DAY_OF_MONTH' columns
+    records = add_calendar_columns(partial).drop(columns=['YEAR', 'MONTH', 'DAY_OF_MONTH'])
+    # Sort the records by the 'Date' column
+    return records.sort_values(by='Date', kind='stable')
+
+# Function to run the whole processing stage over ingested records or over partial aggregates of them
+def process_records(records):
+    return finalize(records if 'humidity_sum' in records else partial_aggregate(records))
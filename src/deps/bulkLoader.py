@@ -0,0 +1,73 @@
+'''
+The bulk loader streams pandas dataframes into PostgreSQL tables through COPY ... FROM STDIN. The dataframe is
+rendered to CSV one slice at a time into an in-memory buffer, so the whole table is never duplicated as text, and
+every load runs in a single transaction that either commits all of its rows or raises.
+
+'''
+# Importation of libraries
+import io, time, collections
+
+# Number of dataframe rows rendered to CSV text at a time
+slice_rows = 100000
+
+# Size (in bytes) of the reads PostgreSQL makes from the CSV stream
+copy_buffer_size = 1 << 16
+
+# Report of a bulk load: the target table, the number of rows loaded and the elapsed seconds
+class LoadReport(collections.namedtuple("LoadReport", ["table", "rows", "seconds"])):
+    __slots__ = ()
+
+    # Number of rows loaded per second
+    @property
+    def rows_per_second(self):
+        return self.rows / self.seconds if self.seconds > 0 else float(self.rows)
+
+# File-like object that renders a dataframe to CSV text slice by slice as PostgreSQL reads it
+class DataFrameCSVStream:
+    def __init__(self, records, date_format="%Y-%m-%d"):
+        # Lazily slice the dataframe so only one slice is rendered to text at a time
+        self._slices = (records.iloc[start:start + slice_rows] for start in range(0, len(records), slice_rows))
+        self._date_format = date_format
+        self._current = io.StringIO()
+
+    def read(self, size=-1):
+        # Read from the current slice and render the next one once it is exhausted
+        data = self._current.read(size)
+        while not data:
+            piece = next(self._slices, None)
+            if piece is None:
+                return ""
+            self._current = io.StringIO(piece.to_csv(header=False, index=False, date_format=self._date_format))
+            data = self._current.read(size)
+        return data
+
+# Function to copy a dataframe into a table inside the caller's transaction
+def copy_dataframe(cursor, table, records, columns):
+    # Build the COPY statement for the target columns; empty CSV fields are loaded as NULL
+    postgreSQL = f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)"
+    # Stream the dataframe into the table
+    cursor.copy_expert(postgreSQL, DataFrameCSVStream(records), size=copy_buffer_size)
+    # Return the number of copied rows
+    return len(records)
+
+# Function to load a dataframe into a table in a single transaction and report the throughput
+def load_dataframe(db_conn, table, records, columns):
+    # Record the start time of the load
+    start = time.perf_counter()
+    # Copy the rows and commit them, the connection context manager rolls back and re-raises on failure
+    with db_conn, db_conn.cursor() as cursor:
+        rows = copy_dataframe(cursor, table, records, columns)
+    # Return the load report
+    return LoadReport(table, rows, time.perf_counter() - start)
+
+# Function to upsert a dataframe into a table on its unique key inside the caller's transaction
+def upsert_dataframe(cursor, table, records, columns, key_columns, update_sql):
+    # Copy the rows into a temporary table shaped like the target table
+    staging = f"{table}_upsert"
+    cursor.execute(f"DROP TABLE IF EXISTS {staging}; CREATE TEMP TABLE {staging} (LIKE {table} INCLUDING DEFAULTS) ON COMMIT DROP;")
+    copy_dataframe(cursor, staging, records, columns)
+    # Insert the rows into the target table, updating the rows whose key already exists
+    column_list = ", ".join(columns)
+    cursor.execute(f"INSERT INTO {table} ({column_list}) SELECT {column_list} FROM {staging} ON CONFLICT ({', '.join(key_columns)}) DO UPDATE SET {update_sql};")
+    # Return the number of inserted or updated rows
+    return cursor.rowcount
@@ -0,0 +1,74 @@
+'''
+The bulk reader streams the result of a query from PostgreSQL into pandas through COPY (SELECT ...) TO STDOUT, so no
+Python object is built for every row and value. A background thread runs the COPY over a pooled connection and writes
+the CSV text into a pipe, while the C parser of pandas reads the other end straight into typed columns, the whole
+result at once or chunk by chunk. The caller types the columns, so DECIMAL and NUMERIC values arrive as float64 instead
+of Decimal objects, and the result is never held as text in memory.
+
+'''
+# Importation of libraries
+import os, threading, pandas
+import connPool
+
+# Size (in bytes) of the buffer between the COPY stream and the pipe, so the rows are written in large blocks
+pipe_buffer_size = 1 << 20
+
+# Function to start copying the result of a query into a pipe from a background thread, returning the read end of the
+# pipe, the thread and the list receiving the error of the copy
+def start_copy(query, params=None):
+    read_fd, write_fd = os.pipe()
+    reader, writer = os.fdopen(read_fd, "rb"), os.fdopen(write_fd, "wb", buffering=pipe_buffer_size)
+    errors = []
+
+    def copy():
+        try:
+            with connPool.connection() as db_conn, db_conn, db_conn.cursor() as cursor:
+                # Bind the parameters into the query, in the encoding of the connection
+                statement = cursor.mogrify(query, params).strip().rstrip(b";")
+                cursor.copy_expert(b"COPY (" + statement + b") TO STDOUT WITH (FORMAT csv, HEADER)", writer)
+        except BaseException as error:
+            errors.append(error)
+        finally:
+            # Closing the write end ends the input of the parser, a reader closed early makes the flush fail
+            try:
+                writer.close()
+            except OSError:
+                pass
+
+    thread = threading.Thread(target=copy, name="bulk-reader", daemon=True)
+    thread.start()
+    return reader, thread, errors
+
+# Function to close the pipe of a copy and wait for its thread, raising the error of the copy when there is one
+def finish_copy(reader, thread, errors):
+    reader.close()
+    thread.join()
+    if errors and not isinstance(errors[0], BrokenPipeError):
+        raise errors[0]
+
+# Function to read the result of a query into a dataframe with the given column types
+def read_query(query, params=None, dtype=None):
+    reader, thread, errors = start_copy(query, params)
+    try:
+        frame = pandas.read_csv(reader, dtype=dtype)
+    except Exception:
+        # An error of the query leaves the parser without input, report the error of the query instead
+        finish_copy(reader, thread, errors)
+        raise
+    finish_copy(reader, thread, errors)
+    return frame
+
+# Function to iterate over the result of a query in dataframes of 'chunksize' rows with the given column types
+def iter_query(query, params=None, dtype=None, chunksize=100000):
+    reader, thread, errors = start_copy(query, params)
+    try:
+        for chunk in pandas.read_csv(reader, dtype=dtype, chunksize=chunksize):
+            yield chunk
+    except Exception:
+        finish_copy(reader, thread, errors)
+        raise
+    except GeneratorExit:
+        # The caller stopped early, closing the pipe stops the copy
+        finish_copy(reader, thread, [])
+        raise
+    finish_copy(reader, thread, errors)
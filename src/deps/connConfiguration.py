@@ -3,3 +3,6 @@ host = 'database'  # The hostname or IP address of the PostgreSQL server
 database = 'database'  # The name of the PostgreSQL database
 login = 'datapipeline'  # The login username for accessing the database
 pw = 'datapipeline'  # The password for the login username
+pool_min_size = 1  # The number of connections each service keeps open in its connection pool
+pool_max_size = 8  # The maximum number of connections each service opens at once, further checkouts wait for a free one
+pool_health_check_seconds = 30  # The idle time (in seconds) after which a pooled connection is probed before being handed out
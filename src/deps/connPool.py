@@ -0,0 +1,102 @@
+'''
+The connection pool shares PostgreSQL connections between the tasks of a service, so every query no longer pays for a
+new connection handshake and authentication. Connections are checked out with a context manager that returns them to
+the pool, rolled back to a clean state, when the block ends. A connection idle for longer than the health check interval
+is probed with a trivial query before being handed out, and a broken one is discarded and replaced.
+
+'''
+# Importation of libraries
+import time, threading, contextlib, psycopg2, psycopg2.pool, psycopg2.extensions
+import connConfiguration
+
+# Shared pool and the bookkeeping of the pooled connections, created on first use
+_pool = None
+_slots = None
+_last_used = {}
+_lock = threading.Lock()
+
+# Function to get the shared connection pool, creating it on first use
+def get_pool():
+    global _pool, _slots
+    with _lock:
+        if _pool is None:
+            _pool = psycopg2.pool.ThreadedConnectionPool(
+                connConfiguration.pool_min_size,
+                connConfiguration.pool_max_size,
+                host=connConfiguration.host,
+                dbname=connConfiguration.database,
+                user=connConfiguration.login,
+                password=connConfiguration.pw,
+            )
+            # Make checkouts wait for a free connection instead of failing once the pool is exhausted
+            _slots = threading.BoundedSemaphore(connConfiguration.pool_max_size)
+        return _pool
+
+# Function to check that a pooled connection is still usable
+def healthy(db_conn):
+    if db_conn.closed:
+        return False
+    # Only probe the connections that have been idle for longer than the health check interval
+    if time.monotonic() - _last_used.get(id(db_conn), 0) < connConfiguration.pool_health_check_seconds:
+        return True
+    try:
+        with db_conn.cursor() as cursor:
+            cursor.execute("SELECT 1")
+        db_conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+# Function to check a healthy connection out of the pool
+def checkout():
+    pool = get_pool()
+    _slots.acquire()
+    try:
+        while True:
+            db_conn = pool.getconn()
+            if healthy(db_conn):
+                return db_conn
+            # Discard the broken connection, the pool opens a new one on the next checkout
+            _last_used.pop(id(db_conn), None)
+            pool.putconn(db_conn, close=True)
+    except BaseException:
+        _slots.release()
+        raise
+
+# Function to return a connection to the pool in a clean state
+def release(db_conn):
+    try:
+        broken = db_conn.closed != 0
+        if not broken:
+            try:
+                # Roll back an unfinished transaction and restore the default transaction mode
+                if db_conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    db_conn.rollback()
+                db_conn.autocommit = False
+                db_conn.notifies.clear()
+            except psycopg2.Error:
+                broken = True
+        _last_used[id(db_conn)] = time.monotonic()
+        if broken:
+            _last_used.pop(id(db_conn), None)
+        get_pool().putconn(db_conn, close=broken)
+    finally:
+        _slots.release()
+
+# Context manager checking a connection out of the pool for the duration of a block
+@contextlib.contextmanager
+def connection():
+    db_conn = checkout()
+    try:
+        yield db_conn
+    finally:
+        release(db_conn)
+
+# Function to close every pooled connection, for instance before the process exits
+def close_all():
+    global _pool
+    with _lock:
+        if _pool is not None:
+            _pool.closeall()
+            _pool = None
+        _last_used.clear()
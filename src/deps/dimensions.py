@@ -0,0 +1,74 @@
+'''
+The dimension tables hold every airport and aircraft once under a small integer surrogate key, so the fact tables
+('flights', 'flights_weekly', 'humidity_rank' and its summaries) store two-byte airport keys and four-byte aircraft keys
+instead of repeating their codes as text in every row and index entry. The services keep the codes dictionary-encoded as
+pandas categoricals, and a dataframe is encoded by looking up the surrogate keys of its categories only (a few hundred
+airports and a few thousand aircraft) and indexing them with the integer codes of the rows. Readers join the dimension
+tables back only to display the codes.
+
+'''
+# Importation of libraries
+import collections, numpy
+
+# Key of the advisory lock serializing the schema changes of the services, which share the dimension tables
+schema_lock = 720301
+
+# SQL statement creating the dimension tables, holding the schema lock until the end of the caller's transaction so the
+# services starting together do not create the same tables concurrently
+schema = f"""
+    SELECT pg_advisory_xact_lock({schema_lock});
+    CREATE TABLE IF NOT EXISTS airports (airport_id SMALLSERIAL PRIMARY KEY, code VARCHAR(25) NOT NULL UNIQUE);
+    CREATE TABLE IF NOT EXISTS aircraft (aircraft_id SERIAL PRIMARY KEY, tail_num VARCHAR(30) NOT NULL UNIQUE);
+"""
+
+# Dimension of a key column of the fact tables: the dimension table, its surrogate key column and its code column
+Dimension = collections.namedtuple("Dimension", ["table", "key", "code"])
+
+# Dimensions of the key columns of the fact tables
+fact_keys = {
+    "aircraft_id": Dimension("aircraft", "aircraft_id", "tail_num"),
+    "origin_id": Dimension("airports", "airport_id", "code"),
+    "dest_id": Dimension("airports", "airport_id", "code"),
+}
+
+# Key columns of the fact tables replacing the code columns of the source
+source_columns = {"TAIL_NUM": "aircraft_id", "ORIGIN": "origin_id", "DEST": "dest_id"}
+
+# Function to get the surrogate keys of codes inside the caller's transaction, adding the codes not seen before to the
+# dimension table
+def surrogate_keys(cursor, dimension, codes):
+    codes = [str(code) for code in codes]
+    if not codes:
+        return numpy.empty(0, dtype=numpy.int32)
+    # Only insert the missing codes, a conflicting insert would still use up a value of the key sequence
+    cursor.execute(f"""
+        INSERT INTO {dimension.table} ({dimension.code})
+        SELECT new.code FROM unnest(%s::text[]) AS new (code)
+        WHERE NOT EXISTS (SELECT 1 FROM {dimension.table} d WHERE d.{dimension.code} = new.code)
+        ORDER BY new.code
+        ON CONFLICT ({dimension.code}) DO NOTHING;
+    """, (codes,))
+    cursor.execute(f"SELECT {dimension.code}, {dimension.key} FROM {dimension.table} WHERE {dimension.code} = ANY(%s)", (codes,))
+    keys = dict(cursor.fetchall())
+    # Return the keys in the order of the codes
+    return numpy.array([keys[code] for code in codes], dtype=numpy.int32)
+
+# Function to replace the code columns of a dataframe with the surrogate key columns of the fact tables inside the
+# caller's transaction
+def encode(cursor, records):
+    keys = {}
+    for column, fact_key in source_columns.items():
+        # A no-op for the columns read as categoricals already
+        values = records[column].astype("category")
+        codes = values.cat.codes.to_numpy()
+        # The group-by of the transform engine drops the keys with a missing code, so every row has a code
+        if (codes < 0).any():
+            raise ValueError(f"missing {column} codes cannot be encoded")
+        keys[fact_key] = surrogate_keys(cursor, fact_keys[fact_key], values.cat.categories)[codes]
+    return records.drop(columns=list(source_columns)).assign(**keys)
+
+# Function to read the codes of a key column of the fact tables by surrogate key, to display them
+def names(cursor, fact_key):
+    dimension = fact_keys[fact_key]
+    cursor.execute(f"SELECT {dimension.key}, {dimension.code} FROM {dimension.table}")
+    return dict(cursor.fetchall())
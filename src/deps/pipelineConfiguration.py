@@ -0,0 +1,38 @@
+# Tuning configuration shared by the data pipeline, cluster model and user interface services
+
+# Data Pipeline ingestion
+incremental_ingestion = True  # Read only the data appended since the stored watermark, False reloads the whole source every run, even when it is unchanged
+ingestion_mode = 'streaming'  # 'batch' builds the whole dataframe before processing, 'streaming' processes and loads chunks as they are read, 'parallel' parses byte ranges in a process pool
+chunksize = 10000  # The number of CSV rows read per chunk
+memory_budget_mb = 512  # The growth of resident memory (in MB) allowed to the streaming ingestion over its start before partial aggregates are spilled to the database
+spill_interval_chunks = 50  # The number of chunks after which partial aggregates are spilled to the database even when under budget
+parallel_workers = None  # The number of worker processes of the parallel ingestion, None uses every CPU available
+columnar_cache = False  # Keep the parsed columns of the source next to it, so full reads of an unchanged source skip CSV parsing; only used when incremental_ingestion is False
+cache_snapshots_kept = 2  # The number of columnar cache snapshots kept per source, older ones are evicted
+retention_months = None  # The number of months of flights kept, counted back from the newest month; older monthly partitions are dropped. None keeps all history
+source_pattern = None  # A glob, directory or manifest file (one path per line) of CSV, CSV.gz and CSV.zst source files loaded file by file, None reads the single source file
+source_workers = 4  # The number of source files read and decompressed at a time by worker processes
+
+# Cluster Model
+cluster_backend = 'optimal1d'  # 'optimal1d' is exact 1-D k-means (Jenks) on humidity, 'kmeans' the original KMeans on week and humidity, 'minibatch' a warm-started MiniBatchKMeans
+retrain_interval_minutes = 60  # The age (in minutes) after which the cluster model is fully retrained, runs in between only score changed keys
+drift_threshold = 2.0  # The humidity shift of a rank mean away from its centroid that triggers an early retraining
+cluster_partition_column = None  # The key column of the weekly aggregates ('origin_id', 'dest_id' or 'aircraft_id') whose values are each fitted with their own model in parallel, None fits one global model
+cluster_partition_min_rows = 500  # The number of weekly keys below which a partition is ranked by the global model
+cluster_workers = None  # The number of worker processes fitting the partitions with the kmeans and minibatch backends (optimal1d solves them all in process), None uses every CPU available
+run_wait_seconds = 110  # The time (in seconds) a cluster model run listens for the conclusion of a Data Pipeline run before skipping until its next schedule
+rank_snapshots_kept = 2  # The number of previous 'humidity_rank' tables kept as snapshots after a retraining swaps new ranks in, for rollback
+swap_lock_timeout_seconds = 5  # The time (in seconds) the swap of a retrained 'humidity_rank' waits for readers before failing and retrying
+
+# Instrumentation
+stage_metrics = True  # Record the wall time, CPU time, memory and row counts of every stage into the 'stage_metrics' table
+metrics_flush_seconds = 5  # The interval (in seconds) at which the queued stage metrics are written in one batch
+trace_memory = False  # Also trace the peak Python allocations of every stage with tracemalloc, which slows allocation-heavy stages down
+profile_stages = ()  # The names of the stages (task functions) dumping a cProfile of every run, True profiles them all
+profile_directory = 'profiles'  # The directory the cProfile dumps are written to
+
+# User Interface
+data_api_port = 8081  # The loopback port of the data API serving the table pages, proxied by nginx under /api/
+data_api_page_size = 100  # The number of rows of a table page fetched by the user interface
+data_api_max_page_size = 1000  # The largest page a client may request from the data API
+data_api_date_window_months = 3  # The months of flights paged by the data API when no date range is given, counted back from the newest month
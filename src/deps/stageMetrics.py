@@ -0,0 +1,203 @@
+'''
+The stage metrics record how every stage (Prefect task) of the services performs: its wall time, CPU time (of the task
+thread and of the worker processes it waited on), peak resident memory sampled while it runs, the rows it received and
+returned, and the flow run it belongs to. Stages are measured with the `timed` decorator or the `stage` context manager,
+and a stage may report its row counts itself through `current()`. Measurements are queued in memory and written to the
+'stage_metrics' table in batches by a background thread, so a stage never waits on an INSERT. A stage listed in
+`profile_stages` additionally dumps a cProfile of its run into the profile directory.
+
+'''
+# Importation of libraries
+import os, time, queue, atexit, resource, datetime, threading, functools, contextlib, cProfile, tracemalloc
+import psycopg2.extras
+import connPool, pipelineConfiguration
+
+# Measurements waiting to be written, and the background writer draining them
+_pending = queue.Queue()
+_writer = None
+_writer_lock = threading.Lock()
+_active = threading.local()
+
+# Process-wide identifier used when a stage runs outside of a Prefect flow run
+_process_run_id = f"{os.getpid()}-{int(time.time())}"
+
+# Measurement of one run of a stage
+class Stage:
+    def __init__(self, service, name):
+        self.service = service
+        self.name = name
+        self.rows_in = None
+        self.rows_out = None
+        self.status = "ok"
+
+# Function to get the stage measured in the current thread, so a stage can report its own row counts
+def current():
+    stack = getattr(_active, "stack", None)
+    return stack[-1] if stack else Stage(None, None)
+
+# Function to identify the flow run a stage belongs to
+def current_run_id():
+    try:
+        import prefect
+        run_id = prefect.context.get("flow_run_id") or prefect.context.get("scheduled_start_time")
+    except ImportError:
+        run_id = None
+    return str(run_id) if run_id else _process_run_id
+
+# Function to count the rows of a stage input or output, when it has any
+def count_rows(value):
+    shape = getattr(value, "shape", None)
+    if shape:
+        return int(shape[0])
+    if isinstance(value, (list, tuple)):
+        counts = [count_rows(item) for item in value]
+        return sum(count for count in counts if count is not None) if any(count is not None for count in counts) else None
+    return None
+
+# Function to read the current resident memory of the process in MB
+def rss_mb():
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize() / 1048576
+    except OSError:
+        return None
+
+# Interval (in seconds) at which the resident memory of the process is sampled while a stage runs
+sample_interval = 0.02
+
+# Sampler of the peak resident memory of the process while a stage runs, ru_maxrss only holds the peak since start-up
+class PeakMemory:
+    def __init__(self, interval=sample_interval):
+        self.interval = interval
+        self.peak = rss_mb()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, rss_mb())
+
+    # Function to start sampling, where the proc filesystem is available
+    def start(self):
+        if self.peak is not None:
+            self._thread = threading.Thread(target=self._sample, name="stage-memory-sampler", daemon=True)
+            self._thread.start()
+        return self
+
+    # Function to stop sampling and return the peak resident memory in MB
+    def stop(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self.peak = max(self.peak, rss_mb())
+        return self.peak
+
+# Function to check whether the profile of a stage has been requested
+def profiled(name):
+    stages = pipelineConfiguration.profile_stages
+    return stages is True or name in (stages or ())
+
+# Context manager measuring a stage of a service
+@contextlib.contextmanager
+def stage(service, name):
+    if not pipelineConfiguration.stage_metrics:
+        yield Stage(service, name)
+        return
+    measured = Stage(service, name)
+    stack = _active.__dict__.setdefault("stack", [])
+    stack.append(measured)
+    # Trace the Python allocations of the stage when requested, tracing slows allocation-heavy stages down
+    tracing = pipelineConfiguration.trace_memory and not tracemalloc.is_tracing()
+    if tracing:
+        tracemalloc.start()
+    profile = cProfile.Profile() if profiled(name) else None
+    if profile:
+        try:
+            profile.enable()
+        except ValueError:
+            # Another profiler is already active in the process
+            profile = None
+    started_at = datetime.datetime.now()
+    memory = PeakMemory().start()
+    wall, cpu, children = time.perf_counter(), time.thread_time(), resource.getrusage(resource.RUSAGE_CHILDREN)
+    try:
+        yield measured
+    except BaseException as error:
+        measured.status = type(error).__name__
+        raise
+    finally:
+        wall, cpu = time.perf_counter() - wall, time.thread_time() - cpu
+        # Add the CPU time of the worker processes reaped during the stage
+        reaped = resource.getrusage(resource.RUSAGE_CHILDREN)
+        cpu += (reaped.ru_utime - children.ru_utime) + (reaped.ru_stime - children.ru_stime)
+        peak_mb = memory.stop()
+        traced_mb = None
+        if tracing:
+            traced_mb = tracemalloc.get_traced_memory()[1] / 1048576
+            tracemalloc.stop()
+        if profile:
+            profile.disable()
+            os.makedirs(pipelineConfiguration.profile_directory, exist_ok=True)
+            profile.dump_stats(os.path.join(pipelineConfiguration.profile_directory, f"{service}-{name}-{started_at:%Y%m%d%H%M%S}.prof"))
+        stack.pop()
+        # Queue the measurement, the background writer stores it
+        record((service, current_run_id(), name, started_at, wall, cpu, rss_mb(), peak_mb, traced_mb, measured.rows_in, measured.rows_out,
+                measured.status))
+
+# Decorator measuring every call of a function as a stage of a service, counting the rows of its arguments and result
+def timed(service, name=None):
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with stage(service, name or function.__name__) as measured:
+                measured.rows_in = count_rows(list(args) + list(kwargs.values()))
+                result = function(*args, **kwargs)
+                if measured.rows_out is None:
+                    measured.rows_out = count_rows(result)
+                return result
+        return wrapper
+    return decorator
+
+# Function to queue a measurement and make sure the background writer runs
+def record(measurement):
+    global _writer
+    _pending.put(measurement)
+    with _writer_lock:
+        if _writer is None or not _writer.is_alive():
+            _writer = threading.Thread(target=write_loop, name="stage-metrics-writer", daemon=True)
+            _writer.start()
+
+# Function to write the queued measurements in one batch
+def flush():
+    batch = []
+    while True:
+        try:
+            batch.append(_pending.get_nowait())
+        except queue.Empty:
+            break
+    if not batch:
+        return 0
+    try:
+        with connPool.connection() as db_conn, db_conn, db_conn.cursor() as cursor:
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS stage_metrics (id SERIAL PRIMARY KEY, service VARCHAR(40), run_id VARCHAR(60), stage VARCHAR(80),
+                    started_at TIMESTAMP, wall_seconds DOUBLE PRECISION, cpu_seconds DOUBLE PRECISION, rss_mb DOUBLE PRECISION,
+                    peak_rss_mb DOUBLE PRECISION, peak_traced_mb DOUBLE PRECISION, rows_in BIGINT, rows_out BIGINT, status VARCHAR(40));
+            """)
+            psycopg2.extras.execute_values(cursor, """
+                INSERT INTO stage_metrics (service, run_id, stage, started_at, wall_seconds, cpu_seconds, rss_mb, peak_rss_mb,
+                    peak_traced_mb, rows_in, rows_out, status) VALUES %s
+            """, batch)
+    except psycopg2.Error as error:
+        # Metrics never fail the services, the batch is dropped
+        print(f"Stage metrics of {len(batch)} stages dropped: {error}")
+    return len(batch)
+
+# Function run by the background writer, flushing the queued measurements periodically
+def write_loop():
+    while True:
+        time.sleep(pipelineConfiguration.metrics_flush_seconds)
+        flush()
+
+# Write the measurements still queued when the process exits
+atexit.register(flush)
@@ -0,0 +1,15 @@
+'''
+Sizing of the process pools of the services. The Data Pipeline parses byte ranges and source files in worker processes
+and the Cluster Model fits its partitions in them; both default to one worker per CPU the process may run on, which is
+the CPU affinity of the container rather than the CPU count of the host.
+
+'''
+# Importation of libraries
+import os
+
+# Function to count the CPUs available to the process
+def available_cpus():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
@@ -0,0 +1,211 @@
+'''
+The data API serves the tables shown by the user interface one page at a time, so the generated pages stay small and
+render in constant time however large the tables grow. It listens on the loopback interface behind the nginx '/api/'
+location and answers GET /api/<table>?origin=&dest=&week=&rank=&sort=&order=&limit=&after= with a JSON object holding
+the rows of the page as columns, ready for a Bokeh ColumnDataSource, and the cursor of the next page.
+
+Pages are found with keyset pagination: the rows are ordered by the requested sort column followed by the unique key of
+the table, and the cursor holds the ordering values of the last row served, so every page is an index range scan that
+starts where the previous page ended instead of skipping the rows of all the previous pages. The tables store the
+surrogate keys of the aircraft and airports, which the API joins back to their codes for the rows of the page only.
+
+'''
+# Importation of libraries
+import json, base64, decimal, datetime, threading, psycopg2
+from http import server
+from urllib import parse
+import connPool, pipelineConfiguration, dimensions
+
+# Function to build the join of a table to a dimension table, resolving a surrogate key to its code for display
+def dimension_join(table, fact_key, alias):
+    dimension = dimensions.fact_keys[fact_key]
+    return f"LEFT JOIN {dimension.table} {alias} ON {alias}.{dimension.key} = {table}.{fact_key}"
+
+# Function to build the filter of a table on a code, through the surrogate key the table stores
+def code_filter(table, fact_key):
+    dimension = dimensions.fact_keys[fact_key]
+    return f"{table}.{fact_key} = (SELECT {dimension.key} FROM {dimension.table} WHERE {dimension.code} = %s)"
+
+# Tables served by the API: the joins to the dimension tables, the selected columns, the filters, the sortable columns
+# and the unique key breaking ties, all qualified with their table so ORDER BY never resolves to a converted output
+# column of the same name. The codes of the aircraft and airports sort by their surrogate key, which the indexes cover
+tables = {
+    "flights": {
+        "joins": [dimension_join("flights", "aircraft_id", "aircraft"), dimension_join("flights", "origin_id", "origin"), dimension_join("flights", "dest_id", "dest")],
+        "columns": {"tail_num": "aircraft.tail_num", "origin": "origin.code", "dest": "dest.code", "week": "flights.week", "date": "cast(flights.date as text)",
+                    "humidity": "flights.humidity::double precision"},
+        "filters": {"tail_num": code_filter("flights", "aircraft_id"), "origin": code_filter("flights", "origin_id"), "dest": code_filter("flights", "dest_id"),
+                    "week": "flights.week = %s", "date_from": "flights.date >= %s", "date_to": "flights.date <= %s"},
+        "sorts": {"tail_num": "flights.aircraft_id", "origin": "flights.origin_id", "dest": "flights.dest_id", "week": "flights.week", "date": "flights.date",
+                  "humidity": "flights.humidity"},
+        "key": ["flights.aircraft_id", "flights.origin_id", "flights.dest_id", "flights.date"],
+        # Monthly partitioned on date, pages are limited to a window of recent months so old partitions are pruned,
+        # unless a date range is requested
+        "window": "flights.date",
+        "ranges": ["date_from", "date_to"],
+    },
+    "humidity_rank": {
+        "joins": [dimension_join("humidity_rank", "aircraft_id", "aircraft"), dimension_join("humidity_rank", "origin_id", "origin"),
+                  dimension_join("humidity_rank", "dest_id", "dest")],
+        "columns": {"tail_num": "aircraft.tail_num", "origin": "origin.code", "dest": "dest.code", "week": "humidity_rank.week", "humidity": "humidity_rank.humidity",
+                    "rank": "humidity_rank.rank", "partition_label": "humidity_rank.partition_label"},
+        "filters": {"tail_num": code_filter("humidity_rank", "aircraft_id"), "origin": code_filter("humidity_rank", "origin_id"),
+                    "dest": code_filter("humidity_rank", "dest_id"), "week": "humidity_rank.week = %s", "rank": "humidity_rank.rank = %s",
+                    "partition_label": "humidity_rank.partition_label = %s"},
+        "sorts": {"tail_num": "humidity_rank.aircraft_id", "origin": "humidity_rank.origin_id", "dest": "humidity_rank.dest_id", "week": "humidity_rank.week",
+                  "rank": "humidity_rank.rank"},
+        "key": ["humidity_rank.aircraft_id", "humidity_rank.origin_id", "humidity_rank.dest_id", "humidity_rank.week"],
+    },
+    "humidity_rank_origin_week": {
+        "joins": [dimension_join("humidity_rank_origin_week", "origin_id", "origin")],
+        "columns": {"origin": "origin.code", "week": "humidity_rank_origin_week.week", "rank": "humidity_rank_origin_week.rank",
+                    "flights": "humidity_rank_origin_week.flights", "avg_humidity": "humidity_rank_origin_week.avg_humidity"},
+        "filters": {"origin": code_filter("humidity_rank_origin_week", "origin_id"), "week": "humidity_rank_origin_week.week = %s",
+                    "rank": "humidity_rank_origin_week.rank = %s"},
+        "sorts": {"origin": "humidity_rank_origin_week.origin_id", "week": "humidity_rank_origin_week.week", "rank": "humidity_rank_origin_week.rank",
+                  "flights": "humidity_rank_origin_week.flights", "avg_humidity": "humidity_rank_origin_week.avg_humidity"},
+        "key": ["humidity_rank_origin_week.origin_id", "humidity_rank_origin_week.week", "humidity_rank_origin_week.rank"],
+    },
+    "humidity_rank_route": {
+        "joins": [dimension_join("humidity_rank_route", "origin_id", "origin"), dimension_join("humidity_rank_route", "dest_id", "dest")],
+        "columns": {"origin": "origin.code", "dest": "dest.code", "good": "humidity_rank_route.good", "moderate": "humidity_rank_route.moderate",
+                    "bad": "humidity_rank_route.bad", "flights": "humidity_rank_route.flights", "avg_humidity": "humidity_rank_route.avg_humidity"},
+        "filters": {"origin": code_filter("humidity_rank_route", "origin_id"), "dest": code_filter("humidity_rank_route", "dest_id")},
+        "sorts": {"origin": "humidity_rank_route.origin_id", "dest": "humidity_rank_route.dest_id", "bad": "humidity_rank_route.bad",
+                  "flights": "humidity_rank_route.flights", "avg_humidity": "humidity_rank_route.avg_humidity"},
+        "key": ["humidity_rank_route.origin_id", "humidity_rank_route.dest_id"],
+    },
+    "operations": {
+        "joins": [],
+        "columns": {"id": "operations.id", "update": "operations.update", "loaddate": "cast(operations.loaddate as text)"},
+        "filters": {},
+        "sorts": {"id": "operations.id"},
+        "key": ["operations.id"],
+    },
+}
+
+# Error of a request that cannot be answered
+class BadRequest(ValueError):
+    pass
+
+# Function to encode the ordering values of the last row of a page as an opaque cursor
+def encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values, default=str).encode("utf-8")).decode("ascii")
+
+# Function to decode a cursor into the ordering values of the last row served
+def decode_cursor(cursor, length):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+    except ValueError:
+        raise BadRequest("invalid cursor")
+    if not isinstance(values, list) or len(values) != length:
+        raise BadRequest("invalid cursor")
+    return values
+
+# Function to find the first day of the default date window of a table partitioned by month, counted back from its
+# newest partition (named after its month), without reading the table itself
+def window_start(cursor, table):
+    cursor.execute("SELECT max(c.relname) FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid WHERE i.inhparent = %s::regclass", (table,))
+    newest = cursor.fetchone()[0]
+    if newest is None:
+        return None
+    month = int(newest[-6:-2]) * 12 + int(newest[-2:]) - 1 - (pipelineConfiguration.data_api_date_window_months - 1)
+    return datetime.date(month // 12, month % 12 + 1, 1)
+
+# Function to build the query of a page of a table, limited to the dates from 'window' when given
+def page_query(table, query, window=None):
+    spec = tables.get(table)
+    if spec is None:
+        raise BadRequest(f"unknown table {table}")
+    # Order by the sort column followed by the unique key, so the ordering is total and a cursor identifies one row. The
+    # default sort is the column sorting by the first column of the key
+    sort = query.get("sort") or next(name for name, column in spec["sorts"].items() if column == spec["key"][0])
+    if sort not in spec["sorts"]:
+        raise BadRequest(f"cannot sort {table} by {sort}")
+    order = "DESC" if query.get("order", "asc").lower() == "desc" else "ASC"
+    ordering = [spec["sorts"][sort]] + [column for column in spec["key"] if column != spec["sorts"][sort]]
+    try:
+        limit = min(max(int(query.get("limit") or pipelineConfiguration.data_api_page_size), 1), pipelineConfiguration.data_api_max_page_size)
+    except ValueError:
+        raise BadRequest("invalid limit")
+    # Filter on the requested columns
+    conditions, params = [], []
+    for name, condition in spec["filters"].items():
+        if query.get(name):
+            conditions.append(condition)
+            params.append(query[name])
+    if window is not None:
+        conditions.append(f"{spec['window']} >= %s")
+        params.append(window)
+    # Start after the last row of the previous page
+    if query.get("after"):
+        conditions.append(f"({', '.join(ordering)}) {'<' if order == 'DESC' else '>'} ({', '.join(['%s'] * len(ordering))})")
+        params.extend(decode_cursor(query["after"], len(ordering)))
+    selected = ", ".join(f"{expression} AS {name}" for name, expression in spec["columns"].items())
+    cursor_columns = ", ".join(f"{column} AS cursor_{i}" for i, column in enumerate(ordering))
+    postgreSQL = f"""
+        SELECT {selected}, {cursor_columns} FROM {table} {' '.join(spec['joins'])}
+        {'WHERE ' + ' AND '.join(conditions) if conditions else ''}
+        ORDER BY {', '.join(f'{column} {order}' for column in ordering)}
+        LIMIT %s
+    """
+    # Fetch one row more than the page to know whether a next page exists
+    return postgreSQL, params + [limit + 1], list(spec["columns"]), limit
+
+# Function to convert a database value into a JSON value
+def json_value(value):
+    if isinstance(value, decimal.Decimal):
+        return float(value)
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    return value
+
+# Function to fetch a page of a table as columns with the cursor of the next page
+def fetch_page(table, query):
+    with connPool.connection() as db_conn, db_conn, db_conn.cursor() as cursor:
+        # Page the recent months of a partitioned table unless a date range is requested
+        spec = tables.get(table, {})
+        window = window_start(cursor, table) if spec.get("window") and not any(query.get(name) for name in spec["ranges"]) else None
+        postgreSQL, params, columns, limit = page_query(table, query, window)
+        cursor.execute(postgreSQL, params)
+        rows = cursor.fetchall()
+    page, more = rows[:limit], len(rows) > limit
+    return {
+        "rows": {name: [json_value(row[i]) for row in page] for i, name in enumerate(columns)},
+        "next": encode_cursor([json_value(value) for value in page[-1][len(columns):]]) if more else None,
+    }
+
+# Handler of the API requests
+class DataAPIHandler(server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = parse.urlsplit(self.path)
+        parts = [part for part in url.path.split("/") if part]
+        if len(parts) != 2 or parts[0] != "api":
+            return self.reply(404, {"error": "not found"})
+        try:
+            query = {name: values[-1] for name, values in parse.parse_qs(url.query).items()}
+            self.reply(200, fetch_page(parts[1], query))
+        except (BadRequest, psycopg2.DataError) as error:
+            # Reject unknown tables, columns, cursors and filter values of the wrong type
+            self.reply(400, {"error": str(error).strip()})
+
+    # Function to send a JSON response
+    def reply(self, status, body):
+        payload = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.send_header("Cache-Control", "no-store")
+        self.end_headers()
+        self.wfile.write(payload)
+
+    # Keep the request log out of the service output
+    def log_message(self, format, *args):
+        pass
+
+# Function to serve the API from a background thread
+def serve_in_background(host="127.0.0.1", port=None):
+    httpd = server.ThreadingHTTPServer((host, port or pipelineConfiguration.data_api_port), DataAPIHandler)
+    httpd.daemon_threads = True
+    threading.Thread(target=httpd.serve_forever, name="data-api", daemon=True).start()
+    return httpd
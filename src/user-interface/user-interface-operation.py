@@ -6,31 +6,45 @@ finally the clustered humidity data.
 '''
 
 # Importation of the relevant libraries
-import pandas, prefect, sqlalchemy, datetime
-import connConfiguration
-from bokeh import plotting as bokeh_plotting
+import os, prefect, datetime, psycopg2, psycopg2.errors
+import connPool, pipelineConfiguration, stageMetrics, data_api
+from bokeh import io as bokeh_io
+from bokeh import resources as bokeh_resources
 from bokeh import models as bokeh_model
+from bokeh import layouts as bokeh_layouts
 from prefect import schedules as ps
 from prefect import executors as pe
 
-def create_engine_connection():
-    # Create a SQLAlchemy engine using the provided connection configuration
-    db = sqlalchemy.create_engine(
-        f'postgresql+psycopg2://{connConfiguration.login}:{connConfiguration.pw}@{connConfiguration.host}/{connConfiguration.database}', 
-        pool_recycle=3600,  # Set the maximum time (in seconds) that a connection can remain idle in the pool before it is closed and recycled
-        echo=False  # Determine whether SQL statements should be logged
-    ).connect()  # Connect to the database using the engine
-    # Return the database connection object
-    return db
-
-def close_connection(DBconn):
-    # Close the provided database connection
-    DBconn.close()
-
-def create_data_table(temp_df, columns):
-    # Create a ColumnDataSource object using the provided temporary DataFrame
-    source = bokeh_model.ColumnDataSource(temp_df)
-    # Create a DataTable object using the ColumnDataSource and specified columns
+# Data version of every page when it was last rendered
+rendered_versions = {}
+
+# JavaScript loading a page of a table from the data API into the data source of the table,
+# the cursors of the pages shown before are kept so the previous page can be loaded again
+load_page_code = """
+    const state = window.dataApiState = window.dataApiState || {cursors: [], next: null}
+    if (action === "first") state.cursors = []
+    else if (action === "next" && state.next !== null) state.cursors.push(state.next)
+    else if (action === "previous") state.cursors.pop()
+    const params = new URLSearchParams({limit: String(page_size), sort: sort.value, order: order.value})
+    filter_inputs.forEach((input, i) => { if (input.value.trim()) params.set(filter_names[i], input.value.trim()) })
+    if (state.cursors.length) params.set("after", state.cursors[state.cursors.length - 1])
+    source.data_url = `/api/${table}?${params}`
+    source.get_data("replace")
+"""
+
+# JavaScript adapting the data API response to the data source, keeping the cursor of the next page
+adapter_code = """
+    const state = window.dataApiState = window.dataApiState || {cursors: [], next: null}
+    const response = cb_data.response
+    state.next = response.next
+    next_button.disabled = response.next === null
+    previous_button.disabled = state.cursors.length === 0
+    status.text = `Page ${state.cursors.length + 1}`
+    return response.rows
+"""
+
+def create_data_table(source, columns):
+    # Create a DataTable object using the data source and specified columns
     dataset = bokeh_model.DataTable(source=source, columns=columns, width=900, height=900, auto_edit=False)
     # Return the created DataTable object
     return dataset
@@ -47,73 +61,134 @@ def create_columns(fields, titles):
     # Return the list of created TableColumn objects
     return columns
 
+def create_paged_table(table, fields, titles, filters, sorts, direction="asc"):
+    # Define the first page requested by the data source when the page opens
+    page_size = pipelineConfiguration.data_api_page_size
+    # Create the inputs filtering and sorting the table
+    filter_inputs = [bokeh_model.TextInput(title=title, width=140) for title in filters.values()]
+    sort = bokeh_model.Select(title="Sort by", value=sorts[0], options=sorts, width=140)
+    order = bokeh_model.Select(title="Order", value=direction, options=["asc", "desc"], width=100)
+    # Create the buttons moving between pages and the page indicator
+    previous_button = bokeh_model.Button(label="Previous page", disabled=True, width=120)
+    next_button = bokeh_model.Button(label="Next page", disabled=True, width=120)
+    status = bokeh_model.Div(text="Page 1")
+    # Create a data source fetching pages of the table from the data API on demand instead of embedding the table
+    source = bokeh_model.AjaxDataSource(
+        data_url=f"/api/{table}?limit={page_size}&sort={sorts[0]}&order={direction}",
+        method="GET",
+        mode="replace",
+        polling_interval=None,
+        data={field: [] for field in fields},
+        adapter=bokeh_model.CustomJS(args=dict(next_button=next_button, previous_button=previous_button, status=status), code=adapter_code),
+    )
+    # Reload the table from its first page when a filter or the sort changes, and page through it with the buttons
+    arguments = dict(source=source, table=table, page_size=page_size, sort=sort, order=order,
+                     filter_inputs=filter_inputs, filter_names=list(filters))
+    for widget in filter_inputs + [sort, order]:
+        widget.js_on_change("value", bokeh_model.CustomJS(args=dict(arguments, action="first"), code=load_page_code))
+    previous_button.js_on_event("button_click", bokeh_model.CustomJS(args=dict(arguments, action="previous"), code=load_page_code))
+    next_button.js_on_event("button_click", bokeh_model.CustomJS(args=dict(arguments, action="next"), code=load_page_code))
+    # Return the table with its controls
+    return bokeh_layouts.column(
+        bokeh_layouts.row(*filter_inputs, sort, order),
+        create_data_table(source, create_columns(fields, titles)),
+        bokeh_layouts.row(previous_button, next_button, status),
+    )
+
+
+# Function to write a page atomically, so nginx never serves a half-written file
+def publish(layout, filename, title):
+    # Save the page to a temporary file next to it, then rename it over the page
+    temporary = os.path.join(os.path.dirname(filename), f".{os.path.basename(filename)}.tmp")
+    bokeh_io.save(layout, filename=temporary, resources=bokeh_resources.CDN, title=title)
+    os.replace(temporary, filename)
+
+# Function to render a page only when the version of its data changed since it was last rendered
+def render_page(page, version, build, title):
+    # An unknown version (tables not created yet) always renders
+    if version is not None and rendered_versions.get(page) == version:
+        return f"{page} unchanged"
+    stamp = bokeh_model.Div(text=f"Data version {version if version is not None else 'unknown'}, rendered at {datetime.datetime.now():%Y-%m-%d %H:%M:%S}")
+    publish(bokeh_layouts.column(stamp, build()), os.path.join("html-files", page), title)
+    rendered_versions[page] = version
+    return f"{page} rendered"
 
 @prefect.task(max_retries=4, retry_delay=datetime.timedelta(seconds=1))
-def clusteredData(operations):
-    # Establish a database connection
-    DBconn = create_engine_connection()
-    # Define the SQL query
-    postgreSQL = """select tail_num, origin, dest, week, humidity, rank from humidity_rank;"""
-    # Execute the SQL query and store the results in a DataFrame
-    temp_df = pandas.read_sql_query(postgreSQL, con=DBconn)
-    # Close the database connection
-    close_connection(DBconn)
+@stageMetrics.timed("user-interface")
+def dataVersions():
+    # Read the data version behind every page in one tiny query: the latest operation, Data Pipeline run and
+    # processed cluster model run
+    try:
+        with connPool.connection() as db_conn, db_conn, db_conn.cursor() as cursor:
+            cursor.execute("""
+                SELECT (SELECT max(id) FROM operations), (SELECT max(run_id) FROM pipeline_runs), (SELECT max(run_id) FROM cluster_model_runs);
+            """)
+            operations, pipeline_run, cluster_run = cursor.fetchone()
+    except psycopg2.errors.UndefinedTable:
+        # The services have not created their tables yet
+        operations = pipeline_run = cluster_run = None
+    return {"operational-updates.html": operations, "datapipeline-table.html": pipeline_run, "clustered-table.html": cluster_run,
+            "origin-summary.html": cluster_run, "route-summary.html": cluster_run}
+
+@prefect.task(max_retries=4, retry_delay=datetime.timedelta(seconds=1))
+@stageMetrics.timed("user-interface")
+def clusteredData(versions):
+    # Define the fields and titles for the columns
+    fields = ["tail_num", "origin", "dest", "week", "humidity", "rank", "partition_label"]
+    titles = ["Tail Number", "Origin Airport", "Destination Airport", "Week", "Humidity", "Humidity Level", "Ranked By"]
+    # Create the paged table, filtered and sorted by the data API, when the ranks changed
+    return render_page("clustered-table.html", versions["clustered-table.html"], lambda: create_paged_table(
+        "humidity_rank", fields, titles,
+        {"origin": "Origin Airport", "dest": "Destination Airport", "week": "Week", "rank": "Humidity Level"},
+        ["tail_num", "origin", "dest", "week", "rank"]), "Clustered Humidity Data")
+
+@prefect.task(max_retries=4, retry_delay=datetime.timedelta(seconds=1))
+@stageMetrics.timed("user-interface")
+def originSummary(versions):
+    # Define the fields and titles for the columns
+    fields = ["origin", "week", "rank", "flights", "avg_humidity"]
+    titles = ["Origin Airport", "Week", "Humidity Level", "Flights", "Average Humidity"]
+    # Create the paged table of the ranks per origin airport and week, when the ranks changed
+    return render_page("origin-summary.html", versions["origin-summary.html"], lambda: create_paged_table(
+        "humidity_rank_origin_week", fields, titles,
+        {"origin": "Origin Airport", "week": "Week", "rank": "Humidity Level"},
+        ["origin", "week", "rank", "flights", "avg_humidity"]), "Humidity Levels per Origin Airport and Week")
+
+@prefect.task(max_retries=4, retry_delay=datetime.timedelta(seconds=1))
+@stageMetrics.timed("user-interface")
+def routeSummary(versions):
     # Define the fields and titles for the columns
-    fields = ["tail_num", "origin", "dest", "week", "humidity", "rank"]
-    titles = ["Tail Number", "Origin Airport", "Destination Airport", "Week", "Humidity", "Humidity Level"]
-    # Create the TableColumn objects
-    columns = create_columns(fields, titles)
-    # Create the DataTable object
-    dataset = create_data_table(temp_df, columns)
-    # Set the output file for the Bokeh plot
-    bokeh_plotting.output_file("html-files/clustered-table.html")
-    # Display the DataTable
-    bokeh_plotting.show(dataset)
+    fields = ["origin", "dest", "good", "moderate", "bad", "flights", "avg_humidity"]
+    titles = ["Origin Airport", "Destination Airport", "Good", "Moderate", "Bad", "Flights", "Average Humidity"]
+    # Create the paged table of the ranks per route, when the ranks changed
+    return render_page("route-summary.html", versions["route-summary.html"], lambda: create_paged_table(
+        "humidity_rank_route", fields, titles,
+        {"origin": "Origin Airport", "dest": "Destination Airport"},
+        ["origin", "dest", "bad", "flights", "avg_humidity"]), "Humidity Levels per Route")
 
 @prefect.task(max_retries=4, retry_delay=datetime.timedelta(seconds=1))
-def dataPipelineData(operations):
-    # Establish a database connection
-    DBconn = create_engine_connection()
-    # Define the SQL query
-    postgreSQL = "select tail_num, origin, dest, week, cast(date as text), humidity from flights;"
-    # Execute the SQL query and store the results in a DataFrame
-    temp_df = pandas.read_sql_query(postgreSQL, con=DBconn)
-    # Close the database connection
-    close_connection(DBconn)
+@stageMetrics.timed("user-interface")
+def dataPipelineData(versions):
     # Define the fields and titles for the columns
     fields = ["tail_num", "origin", "dest", "week", "date", "humidity"]
     titles = ["Tail Number", "Origin Airport", "Destination Airport", "Week", "Date", "Humidity"]
-    # Create the TableColumn objects
-    columns = create_columns(fields, titles)
-    # Create the DataTable object
-    dataset = create_data_table(temp_df, columns)
-    # Set the output file for the Bokeh plot
-    bokeh_plotting.output_file("html-files/datapipeline-table.html")
-    # Display the DataTable
-    bokeh_plotting.show(dataset)
+    # Create the paged table, filtered and sorted by the data API, when the flights changed; without a date range the
+    # data API pages the latest months only, so the older partitions of 'flights' are pruned
+    return render_page("datapipeline-table.html", versions["datapipeline-table.html"], lambda: create_paged_table(
+        "flights", fields, titles,
+        {"origin": "Origin Airport", "dest": "Destination Airport", "week": "Week", "date_from": "From Date (YYYY-MM-DD)", "date_to": "To Date"},
+        ["tail_num", "origin", "dest", "week", "date", "humidity"]), "Data Pipeline Data")
 
 @prefect.task(max_retries=4, retry_delay=datetime.timedelta(seconds=1))
-def message_info():
-    # Establish a database connection
-    DBconn = create_engine_connection()
-    # Define the SQL query
-    postgreSQL = "select id, update, cast(loaddate as text) from operations;"
-    # Execute the SQL query and store the results in a DataFrame
-    temp_df = pandas.read_sql_query(postgreSQL, con=DBconn)
-    # Close the database connection
-    close_connection(DBconn)
+@stageMetrics.timed("user-interface")
+def message_info(versions):
     # Define the fields and titles for the columns
     fields = ["id", "update", "loaddate"]
     titles = ["Task Number", "Update on Task", "Log Data"]
-    # Create the TableColumn objects
-    columns = create_columns(fields, titles)
-    # Create the DataTable object
-    dataset = create_data_table(temp_df, columns)
-    # Set the output file for the Bokeh plot
-    bokeh_plotting.output_file("html-files/operational-updates.html")
-    # Display the DataTable
-    bokeh_plotting.show(dataset)
-    
+    # Create the paged table, the latest updates first, when new updates were logged
+    return render_page("operational-updates.html", versions["operational-updates.html"], lambda: create_paged_table(
+        "operations", fields, titles, {}, ["id"], direction="desc"), "Operational Updates")
+
 def main():
     # Get the current UTC time
     current_time = datetime.datetime.utcnow()
@@ -129,16 +204,26 @@ def main():
     # Create an IntervalSchedule with the calculated initiation time and duration
     varA = ps.IntervalSchedule(start_date=initiation_time, interval=duration)
 
+    # Serve the table pages to the generated pages through nginx
+    data_api.serve_in_background()
+
     # Define the Prefect flow
     with prefect.Flow("User Interface Service", schedule=varA) as flow:
+        # Read the data versions behind the pages with the dataVersions task, idle cycles stop at this query
+        versions = dataVersions()
+
         # Execute the message_info task and store the output in outputA
-        outputA = message_info()
+        outputA = message_info(versions)
+
+        # Execute the dataPipelineData task once message_info is done and update outputA
+        outputA = dataPipelineData(versions, upstream_tasks=[outputA])
 
-        # Execute the dataPipelineData task using outputA as input and update outputA
-        outputA = dataPipelineData(outputA)
+        # Execute the clusteredData task once dataPipelineData is done and update outputA
+        outputA = clusteredData(versions, upstream_tasks=[outputA])
 
-        # Execute the clusteredData task using outputA as input and update outputA
-        outputA = clusteredData(outputA)
+        # Execute the originSummary and routeSummary tasks once clusteredData is done and update outputA
+        outputA = originSummary(versions, upstream_tasks=[outputA])
+        outputA = routeSummary(versions, upstream_tasks=[outputA])
 
         # Print the final outputA
         print(outputA)